@@ -5,17 +5,156 @@ from __future__ import print_function
 import sublime
 import sublime_plugin
 import os
+import sys
 import threading
 import subprocess
 import functools
+import bisect
+import heapq
+import itertools
 import re
+import struct
+import select
+import signal
+import ctypes
+import ctypes.util
+import difflib
+import json
+import time
+from array import array
 from copy import copy
+from collections import deque
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6 of Sublime Text 2
+    class OrderedDict(dict):
+        """
+        Dict that remembers insertion order, with just the methods that are used here
+        """
+
+        def __init__(self):
+            dict.__init__(self)
+            self._keys = []
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                self._keys.append(key)
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            self._keys.remove(key)
+
+        def __iter__(self):
+            return iter(self._keys)
+
+        def pop(self, key, *default):
+            if key in self:
+                self._keys.remove(key)
+            return dict.pop(self, key, *default)
+
+        def setdefault(self, key, default=None):
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+        def clear(self):
+            dict.clear(self)
+            del self._keys[:]
+
+        def keys(self):
+            return list(self._keys)
+
+        def values(self):
+            return [self[key] for key in self._keys]
+
+        def items(self):
+            return [(key, self[key]) for key in self._keys]
 
 IS_ST3 = sublime.version().startswith('3') or sublime.version().startswith('4')
 
 
+SETTINGS_FILE = "Modific.sublime-settings"
+
+DEFAULT_VCS = [
+    {"name": "git", "dir": ".git", "cmd": "git"},
+    {"name": "svn", "dir": ".svn", "cmd": "svn"},
+    {"name": "bzr", "dir": ".bzr", "cmd": "bzr"},
+    {"name": "hg",  "dir": ".hg",  "cmd": "hg"},
+    {"name": "tf",  "dir": "$tf",  "cmd": "C:/Program Files (x86)/Microsoft Visual Studio 11.0/Common7/IDE/TF.exe"}
+]
+
+
 def get_settings():
-    return sublime.load_settings("Modific.sublime-settings")
+    return settings_snapshot.get().settings
+
+
+class SettingsSnapshot(object):
+    """
+    Values that are read on every event, computed once from Modific.sublime-settings.
+    A new snapshot replaces the old one whenever the settings file changes.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.debug = bool(settings.get('debug', False))
+        self.vcs_root_cache_ttl = settings.get('vcs_root_cache_ttl', 2)
+        self.perf_stats = bool(settings.get('perf_stats', True))
+        self.perf_stats_samples = max(1, int(settings.get('perf_stats_samples', 1000)))
+        self.vcs_timeouts = dict(settings.get('vcs_timeouts') or {})
+
+        vcs_settings = settings.get('vcs', DEFAULT_VCS) or DEFAULT_VCS
+        # re-format settings array if user has old format of settings
+        if type(vcs_settings[0]) == list:
+            vcs_settings = [dict(name=name, cmd=cmd, dir='.'+name) for name, cmd in vcs_settings]
+        self.vcs = tuple(dict(vcs) for vcs in vcs_settings)
+
+        # the first entry wins when a VCS is listed more than once
+        self.commands = {}
+        for vcs in self.vcs:
+            self.commands.setdefault(vcs.get('name'), vcs.get('cmd'))
+        self.command_names = dict((cmd, name) for name, cmd in self.commands.items())
+        # (marker directory, vcs) pairs in the order they are probed by get_vcs()
+        self.checks = tuple((vcs['dir'], vcs) for vcs in self.vcs if vcs.get('dir'))
+
+
+class SettingsSnapshotHolder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.settings = None
+
+    def get(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    self.settings = sublime.load_settings(SETTINGS_FILE)
+                    self.settings.add_on_change('modific-snapshot', self.rebuild)
+                    self.snapshot = SettingsSnapshot(self.settings)
+                snapshot = self.snapshot
+        return snapshot
+
+    def rebuild(self):
+        with self.lock:
+            if self.settings is None:
+                return
+            self.snapshot = SettingsSnapshot(self.settings)
+        # the list of VCS (or their marker directories) might have changed
+        vcs_root_cache.invalidate()
+
+    def clear(self):
+        with self.lock:
+            if self.settings is not None:
+                self.settings.clear_on_change('modific-snapshot')
+            self.settings = None
+            self.snapshot = None
+
+
+settings_snapshot = SettingsSnapshotHolder()
 
 
 def get_vcs_settings():
@@ -23,46 +162,303 @@ def get_vcs_settings():
     Returns list of dictionaries
     each dict. represents settings for VCS
     """
+    return [dict(vcs) for vcs in settings_snapshot.get().vcs]
+
+
+def get_user_command(vcs_name):
+    """
+    Returns command that user specified for vcs_name
+    """
+    return settings_snapshot.get().commands.get(vcs_name)
+
 
-    default = [
-        {"name": "git", "dir": ".git", "cmd": "git"},
-        {"name": "svn", "dir": ".svn", "cmd": "svn"},
-        {"name": "bzr", "dir": ".bzr", "cmd": "bzr"},
-        {"name": "hg",  "dir": ".hg",  "cmd": "hg"},
-        {"name": "tf",  "dir": "$tf",  "cmd": "C:/Program Files (x86)/Microsoft Visual Studio 11.0/Common7/IDE/TF.exe"}
-    ]
-    settings = get_settings().get('vcs', default)
+def get_vcs_name(command):
+    """
+    Returns name of the VCS that runs the command (list of arguments)
+    """
+    if not command:
+        return None
+    name = settings_snapshot.get().command_names.get(command[0])
+    if name:
+        return name
+    return os.path.splitext(os.path.basename(command[0]))[0].lower() or None
 
-    # re-format settings array if user has old format of settings
-    if type(settings[0]) == list:
-        settings = [dict(name=name, cmd=cmd, dir='.'+name) for name, cmd in settings]
 
-    return settings
+# Modific only reads repositories, so VCS shouldn't take optional locks or write anything
+# (e.g. git refreshing .git/index), which would contend with user's own VCS commands
+# and change the repository state that caches depend on
+READ_ONLY_ENV = {
+    'git': {'GIT_OPTIONAL_LOCKS': '0'}
+}
 
 
-def get_user_command(vcs_name):
+class VcsTimeoutError(Exception):
+    pass
+
+
+def vcs_timeout(vcs_name):
     """
-    Returns command that user specified for vcs_name
+    Returns time limit (in seconds) for commands of the VCS, or None if they may run forever
     """
+    return settings_snapshot.get().vcs_timeouts.get(vcs_name) or None
 
-    try:
-        return [vcs['cmd'] for vcs in get_vcs_settings() if vcs.get('name') == vcs_name][0]
-    except IndexError:
+
+def start_watchdog(timeout, callback, *args):
+    """
+    Calls callback(*args) in another thread after `timeout` seconds unless the returned timer is cancelled.
+    Returns None if there is no timeout.
+    """
+    if not timeout:
         return None
+    watchdog = threading.Timer(timeout, callback, args)
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+
+def spawn(command, **kwargs):
+    """
+    Same as subprocess.Popen(), but the command gets its own process group,
+    so kill_process_tree() stops the processes it started too (e.g. ssh of svn+ssh:// or git over ssh)
+    """
+    if os.name == 'nt':
+        # taskkill /T finds the children by the process tree, the group keeps console signals (Ctrl+C) away
+        new_process_group = getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0x200)
+        kwargs['creationflags'] = kwargs.get('creationflags', 0) | new_process_group
+    else:
+        if sys.version_info >= (3, 2):
+            kwargs['start_new_session'] = True
+        else:
+            kwargs['preexec_fn'] = os.setsid
+    return subprocess.Popen(command, **kwargs)
+
+
+def kill_process_tree(proc):
+    """
+    Kills a process started by spawn() along with its children
+    """
+    try:
+        if os.name == 'nt':
+            # commands run through the shell on Windows, so the VCS is a child of cmd.exe
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= getattr(subprocess, 'STARTF_USESHOWWINDOW', 1)
+            subprocess.call(['taskkill', '/T', '/F', '/PID', str(proc.pid)], startupinfo=startupinfo,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    try:
+        proc.kill()
+    except OSError:
+        # the process has already exited
+        pass
+
+
+def communicate(proc, stdin=None, timeout=None):
+    """
+    Same as proc.communicate(), but kills the process tree if it runs longer than `timeout` seconds
+    and raises VcsTimeoutError
+    """
+    if not timeout:
+        return proc.communicate(stdin)
+
+    if hasattr(subprocess, 'TimeoutExpired'):
+        try:
+            return proc.communicate(stdin, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(proc)
+            proc.communicate()
+            raise VcsTimeoutError(timeout)
+
+    # python 2 doesn't support timeout argument
+    timer = threading.Timer(timeout, kill_process_tree, [proc])
+    timer.start()
+    try:
+        result = proc.communicate(stdin)
+    finally:
+        timer.cancel()
+    if proc.returncode is not None and proc.returncode < 0:
+        raise VcsTimeoutError(timeout)
+    return result
+
+
+class TfsRootCache(object):
+    """
+    Memoizes results of `tf workfold`.
+    A found root is reused for the whole directory tree under it.
+    A directory that is not in a workspace is remembered until the negative result expires,
+    but only for that directory: a workfold can map one of its subdirectories.
+    """
+
+    # seconds to remember that a directory isn't in a workspace, and that `tf workfold` timed out for it
+    negative_ttl = 300
+    timed_out_ttl = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # normalized directory -> (result, time when it expires or None)
+        self.roots = {}
+        # directory -> event that is set when `tf workfold` for it is finished
+        self.pending = {}
+
+    def lookup(self, directory):
+        """
+        Returns (found, result) tuple
+        """
+        now = time.time()
+        path = directory
+        while True:
+            key = os.path.normcase(path)
+            entry = self.roots.get(key)
+            if entry and entry[1] is not None and entry[1] < now:
+                del self.roots[key]
+                entry = None
+            result = entry and entry[0]
+            if entry and result is None and path == directory:
+                return True, None
+            if result:
+                root = os.path.join(result['root'], '')
+                if os.path.join(directory, '').lower().startswith(root.lower()):
+                    return True, dict(result)
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False, None
+            path = parent
+
+    def set(self, directory, result, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        self.roots[os.path.normcase(directory)] = (result, expires)
+        if result:
+            # other subdirectories of the workfold find it on their way up
+            self.roots[os.path.normcase(os.path.normpath(result['root']))] = (result, expires)
+
+    def clear(self):
+        with self.lock:
+            self.roots.clear()
+
+
+tfs_root_cache = TfsRootCache()
 
 
 def tfs_root(directory):
+    tf_cmd = get_user_command('tf')
+    if not tf_cmd:
+        # TFS isn't configured in `vcs` setting
+        return None
+
+    timeout = get_settings().get('tf_timeout', 5)
+    with tfs_root_cache.lock:
+        found, result = tfs_root_cache.lookup(directory)
+        if found:
+            return result
+        running = tfs_root_cache.pending.get(directory)
+        if running is None:
+            tfs_root_cache.pending[directory] = threading.Event()
+    if running is not None:
+        # another thread is asking tf about the same directory
+        running.wait(timeout + 1)
+        with tfs_root_cache.lock:
+            return tfs_root_cache.lookup(directory)[1]
+
+    result = None
+    ttl = tfs_root_cache.negative_ttl
     try:
-        tf_cmd = get_user_command('tf') or 'tf'
         command = [tf_cmd, 'workfold', directory]
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             shell=True, universal_newlines=False)
-        out, err = p.communicate()
-        m = re.search(r"^ \$\S+: (\S+)$", out, re.MULTILINE)
+        p = spawn(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                  shell=os.name == 'nt', universal_newlines=False)
+        out, err = communicate(p, timeout=timeout)
+        m = re.search(r"^ \$\S+: (\S+)$", _make_text_safeish(out, 'utf-8'), re.MULTILINE)
         if m:
-            return {'root': m.group(1), 'name': 'tf', 'cmd': tf_cmd}
+            result = {'root': m.group(1), 'name': 'tf', 'cmd': tf_cmd}
+            ttl = None
+    except VcsTimeoutError:
+        log('tf workfold timed out for', directory)
+        ttl = tfs_root_cache.timed_out_ttl
     except:
-        return None
+        pass
+
+    with tfs_root_cache.lock:
+        tfs_root_cache.set(directory, result, ttl)
+        tfs_root_cache.pending.pop(directory).set()
+    return result and dict(result)
+
+
+class VcsRootCache(object):
+    """
+    Remembers which VCS root (or lack of one) a directory belongs to.
+
+    Every entry keeps the mtimes of the directories that were walked to resolve it.
+    Creating or removing a VCS dir (.git, .hg, ...) changes the mtime of its parent,
+    so an entry is dropped as soon as one of those stamps is outdated.
+    Stamps are re-checked at most once per `vcs_root_cache_ttl` seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stamp(directories):
+        stamps = []
+        for directory in directories:
+            try:
+                stamps.append((directory, os.stat(directory).st_mtime))
+            except OSError:
+                stamps.append((directory, None))
+        return stamps
+
+    def _is_valid(self, entry, ttl):
+        now = time.time()
+        if now - entry['checked'] < ttl:
+            return True
+        if self._stamp(d for d, _ in entry['stamps']) != entry['stamps']:
+            return False
+        entry['checked'] = now
+        return True
+
+    def get(self, directory, ttl):
+        """
+        Returns (found, vcs) tuple, where `found` tells whether directory is cached
+        """
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is not None and self._is_valid(entry, ttl):
+                self.hits += 1
+                return True, entry['vcs'] and dict(entry['vcs'])
+            self.entries.pop(directory, None)
+            self.misses += 1
+            return False, None
+
+    def set(self, directory, walked, vcs):
+        with self.lock:
+            self.entries[directory] = {
+                'vcs': vcs and dict(vcs),
+                'stamps': self._stamp(walked),
+                'checked': time.time()
+            }
+
+    def invalidate(self, directory=None):
+        """
+        Drops cached entries for the directory and everything below it (or all entries)
+        """
+        with self.lock:
+            if directory is None:
+                self.entries.clear()
+                return
+            prefix = os.path.join(directory, '')
+            for key in list(self.entries):
+                if key == directory or key.startswith(prefix):
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+vcs_root_cache = VcsRootCache()
 
 
 def get_vcs(directory):
@@ -72,24 +468,95 @@ def get_vcs(directory):
     Returns dictionary {name: .., root: .., cmd: .., dir: ..}
     """
 
-    vcs_check = [(lambda vcs: lambda dir: os.path.exists(os.path.join(dir, vcs.get('dir', False)))
-                 and vcs)(vcs) for vcs in get_vcs_settings()]
+    snapshot = settings_snapshot.get()
+    found, vcs = vcs_root_cache.get(directory, snapshot.vcs_root_cache_ttl)
+    if found:
+        return vcs
+
+    vcs = None
+    walked = []
 
     start_directory = directory
     while directory:
-        available = list(filter(bool, [check(directory) for check in vcs_check]))
+        walked.append(directory)
+        available = [vcs for marker, vcs in snapshot.checks if os.path.exists(os.path.join(directory, marker))]
         if available:
-            available[0]['root'] = directory
-            return available[0]
+            vcs = dict(available[0], root=directory)
+            break
 
         parent = os.path.realpath(os.path.join(directory, os.path.pardir))
         if parent == directory:  # /.. == /
             # try TFS as a last resort
             # I'm not sure why we need to do this. Seems like it should find root for TFS in the main loop
-            return tfs_root(start_directory)
+            vcs = tfs_root(start_directory)
+            break
         directory = parent
 
-    return None
+    vcs_root_cache.set(start_directory, walked, vcs)
+    log('vcs root cache:', vcs_root_cache.stats())
+    return vcs
+
+
+def _read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return None
+
+
+def get_git_dir(root):
+    """
+    Returns path to the git directory of the working tree.
+    In worktrees and submodules .git is a file that points to the real directory.
+    """
+    git_dir = os.path.join(root, '.git')
+    if os.path.isfile(git_dir):
+        content = _read_file(git_dir) or b''
+        if content.startswith(b'gitdir:'):
+            git_dir = os.path.normpath(os.path.join(root, content[7:].strip().decode('utf-8')))
+    return git_dir
+
+
+# files that change whenever a commit, checkout or staging happens
+VCS_STATE_FILES = {
+    'hg': [os.path.join('.hg', 'dirstate')],
+    'svn': [os.path.join('.svn', 'wc.db'), os.path.join('.svn', 'entries')],
+    'bzr': [os.path.join('.bzr', 'checkout', 'dirstate')]
+}
+
+
+def get_repo_state(vcs):
+    """
+    Returns hashable value that changes whenever the repository state changes
+    (HEAD moves or the index is updated), or None if the state can't be determined
+    """
+    if vcs['name'] == 'git':
+        git_dir = get_git_dir(vcs['root'])
+        head = _read_file(os.path.join(git_dir, 'HEAD'))
+        if head is None:
+            return None
+        oid = head
+        if head.startswith(b'ref: '):
+            ref = head[5:].decode('utf-8')
+            common_dir = _read_file(os.path.join(git_dir, 'commondir'))
+            common_dir = os.path.normpath(os.path.join(git_dir, common_dir.decode('utf-8'))) if common_dir else git_dir
+            oid = (_read_file(os.path.join(git_dir, ref)) or _read_file(os.path.join(common_dir, ref)) or
+                   _stat(os.path.join(common_dir, 'packed-refs')))
+        return head, oid, _stat(os.path.join(git_dir, 'index'))
+
+    state = tuple(_stat(os.path.join(vcs['root'], f)) for f in VCS_STATE_FILES.get(vcs['name'], []))
+    if not any(state):
+        return None
+    return state
 
 
 def main_thread(callback, *args, **kwargs):
@@ -114,6 +581,17 @@ def _make_text_safeish(text, fallback_encoding, method='decode'):
     return unitext
 
 
+def _decode_leniently(text, fallback_encoding):
+    """
+    Same as _make_text_safeish(), but bytes that can't be decoded are replaced instead of raising an error
+    """
+    try:
+        return _make_text_safeish(text, fallback_encoding)
+    except (LookupError, UnicodeError):
+        # unknown (or empty) `fallback_encoding`, or bytes that are invalid in it too
+        return text.decode('utf-8', 'replace')
+
+
 def do_when(conditional, callback, *args, **kwargs):
     if conditional():
         return callback(*args, **kwargs)
@@ -129,22 +607,445 @@ def log(*args, **kwargs):
     debug = kwargs.get('debug', True)
     settings = kwargs.get('settings', None)
 
-    if not settings:
-        settings = get_settings()
-
-    if debug and not settings.get('debug', False):
+    if debug and not (settings.get('debug', False) if settings else settings_snapshot.get().debug):
         return
 
     print('Modific:', *args)
 
 
+def percentile(values, fraction):
+    """
+    @param values: sorted list of numbers
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class PerfSpan(object):
+    """
+    Context manager that adds its duration to PerfStats
+    """
+
+    def __init__(self, stats, stage, vcs):
+        self.stats = stats
+        self.stage = stage
+        self.vcs = vcs
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add(self.stage, time.time() - self.started, self.vcs)
+
+
+class PerfStats(object):
+    """
+    Timings of the stages of highlighting (spawn, vcs, parse, paint, ...) and event counters.
+
+    Only the latest `perf_stats_samples` timings of every stage and VCS are kept.
+    Collection is turned off by `perf_stats` setting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.totals = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def add(self, stage, seconds, vcs=None):
+        snapshot = settings_snapshot.get()
+        if not snapshot.perf_stats:
+            return
+        key = (stage, vcs)
+        with self.lock:
+            samples = self.samples.get(key)
+            if samples is None or samples.maxlen != snapshot.perf_stats_samples:
+                samples = self.samples[key] = deque(samples or (), maxlen=snapshot.perf_stats_samples)
+            samples.append(seconds)
+            self.totals[key] = self.totals.get(key, 0) + 1
+
+    def span(self, stage, vcs=None):
+        return PerfSpan(self, stage, vcs)
+
+    def count(self, name, vcs=None, n=1):
+        if not settings_snapshot.get().perf_stats:
+            return
+        key = (name, vcs)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def report(self):
+        """
+        Returns dictionary with p50, p95 and max (in ms) of every stage and VCS, and counters
+        """
+        with self.lock:
+            samples = dict((key, sorted(values)) for key, values in self.samples.items())
+            totals = dict(self.totals)
+            counters = dict(self.counters)
+            started = self.started
+
+        stages = []
+        for (stage, vcs), values in sorted(samples.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            stages.append({
+                'stage': stage,
+                'vcs': vcs,
+                'count': totals[(stage, vcs)],
+                'samples': len(values),
+                'p50': round(percentile(values, 0.5) * 1000, 3),
+                'p95': round(percentile(values, 0.95) * 1000, 3),
+                'max': round(values[-1] * 1000, 3),
+            })
+        return {
+            'since': started,
+            'stages': stages,
+            'counters': [{'name': name, 'vcs': vcs, 'count': count}
+                         for (name, vcs), count in sorted(counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))]
+        }
+
+
+perf_stats = PerfStats()
+
+
+def vcs_output(command, working_dir=None, console_encoding=None, env=None):
+    """
+    Runs command synchronously and returns its stdout, or None if the command failed
+    """
+    vcs_name = get_vcs_name(command)
+    if console_encoding:
+        command = [s.encode(console_encoding) for s in command]
+    try:
+        with perf_stats.span('spawn', vcs_name):
+            proc = spawn(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         stdin=subprocess.PIPE, cwd=working_dir or None,
+                         env=dict(os.environ, **env) if env else None,
+                         shell=os.name == 'nt', universal_newlines=False)
+        perf_stats.count('process_spawns', vcs_name)
+        with perf_stats.span('vcs', vcs_name):
+            output = communicate(proc, timeout=vcs_timeout(vcs_name))[0]
+    except VcsTimeoutError:
+        log('command timed out:', command, debug=False)
+        perf_stats.count('timeouts', vcs_name)
+        return None
+    except OSError:
+        return None
+    return output if proc.returncode == 0 else None
+
+
+class GitCatFile(object):
+    """
+    Long-lived `git cat-file --batch` process of a repository.
+    Saves process startup on every blob lookup. The process is restarted if it dies.
+    """
+
+    def __init__(self, cmd, root):
+        self.cmd = cmd
+        self.root = root
+        self.lock = threading.Lock()
+        self.proc = None
+        self.last_used = time.time()
+        # reason why the process was killed by kill(), the command isn't retried then
+        self.killed = None
+
+    def _start(self):
+        log('start git cat-file --batch in', self.root)
+        self.devnull = open(os.devnull, 'wb')
+        self.proc = subprocess.Popen([self.cmd, 'cat-file', '--batch'], cwd=self.root,
+                                     env=dict(os.environ, **READ_ONLY_ENV['git']),
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull)
+        perf_stats.count('process_spawns', 'git')
+
+    def _stop(self):
+        if self.proc:
+            try:
+                self.proc.stdin.close()
+                self.proc.kill()
+                self.proc.wait()
+            except (IOError, OSError):
+                pass
+            self.devnull.close()
+            self.proc = None
+
+    def get(self, spec):
+        """
+        Returns contents of the object (e.g. 'HEAD:path' or ':path') as bytes,
+        or None if there is no such object
+        """
+        with self.lock:
+            with perf_stats.span('cat_file', 'git'):
+                self.last_used = time.time()
+                for attempt in range(2):
+                    if self.proc is None or self.proc.poll() is not None:
+                        self._stop()
+                        self._start()
+                    # e.g. a lazy fetch of a partial clone can block the read
+                    self.killed = None
+                    watchdog = start_watchdog(vcs_timeout('git'), self.kill, 'timed out')
+                    try:
+                        self.proc.stdin.write(spec.encode('utf-8') + b'\n')
+                        self.proc.stdin.flush()
+                        header = self.proc.stdout.readline().split()
+                        if not header:
+                            raise IOError('git cat-file exited')
+                        if header[-1] in (b'missing', b'ambiguous'):
+                            # "<spec> missing", the spec itself can contain spaces
+                            return None
+                        if len(header) != 3 or not header[2].isdigit():
+                            # output is out of sync with the requests
+                            raise IOError('unexpected git cat-file output: ' + repr(header))
+                        data = self.proc.stdout.read(int(header[2]))
+                        self.proc.stdout.read(1)  # trailing newline
+                        # "<sha> blob <size>", contents of other objects (e.g. a tree) are read to keep in sync
+                        return data if header[1] == b'blob' else None
+                    except (IOError, OSError, ValueError) as e:
+                        log('git cat-file failed:', self.killed or e)
+                        self._stop()
+                        if self.killed:
+                            return None
+                    finally:
+                        if watchdog:
+                            watchdog.cancel()
+                return None
+
+    def kill(self, reason='closed'):
+        """
+        Kills the process without taking the lock, so a read that blocks in another thread fails
+        """
+        self.killed = reason
+        proc = self.proc
+        if proc:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def close(self, wait=True):
+        """
+        Stops the process. Returns False if it is in use and `wait` is False.
+        """
+        if not self.lock.acquire(wait):
+            return False
+        try:
+            self._stop()
+        finally:
+            self.lock.release()
+        return True
+
+
+class ServerRegistry(object):
+    """
+    Keeps one long-lived VCS process (e.g. GitCatFile) per repository
+    and closes the ones that were idle for longer than the time in `idle_timeout_setting`
+    """
+
+    def __init__(self, server_class, idle_timeout_setting):
+        self.server_class = server_class
+        self.idle_timeout_setting = idle_timeout_setting
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.reaping = False
+
+    def get(self, cmd, root):
+        with self.lock:
+            process = self.processes.get(root)
+            if process is None or process.cmd != cmd:
+                if process:
+                    process.kill()
+                    process.close(False)
+                process = self.processes[root] = self.server_class(cmd, root)
+            if not self.reaping:
+                self.reaping = True
+                sublime.set_timeout(self.reap, 60000)
+        return process
+
+    def reap(self):
+        """
+        Runs on the main thread, so processes that are in use (their reads can block) are left for the next time
+        """
+        timeout = get_settings().get(self.idle_timeout_setting, 300)
+        with self.lock:
+            for root, process in list(self.processes.items()):
+                if time.time() - process.last_used > timeout and process.close(False):
+                    del self.processes[root]
+            self.reaping = bool(self.processes)
+        if self.reaping:
+            sublime.set_timeout(self.reap, 60000)
+
+    def shutdown(self):
+        with self.lock:
+            for process in self.processes.values():
+                # a blocked read fails once the process is killed, and the reading thread cleans up
+                process.kill()
+                process.close(False)
+            self.processes.clear()
+
+
+git_cat_file = ServerRegistry(GitCatFile, 'git_cat_file_idle_timeout')
+
+
+class HgServerError(Exception):
+    pass
+
+
+class HgCommandServer(object):
+    """
+    Client of Mercurial command server (`hg serve --cmdserver pipe`).
+    Runs hg commands without starting a new Python interpreter each time.
+    See https://www.mercurial-scm.org/wiki/CommandServer
+    """
+
+    def __init__(self, cmd, root):
+        self.cmd = cmd
+        self.root = root
+        self.lock = threading.Lock()
+        self.proc = None
+        self.last_used = time.time()
+        # reason why the process was killed by kill()
+        self.killed = None
+
+    def _read_message(self):
+        header = self.proc.stdout.read(5)
+        if len(header) != 5:
+            raise HgServerError('command server exited')
+        channel, length = struct.unpack('>cI', header)
+        if channel in (b'I', b'L'):
+            # server asks for input, which we never provide
+            return channel, length
+        return channel, self.proc.stdout.read(length)
+
+    def _start(self):
+        log('start hg command server in', self.root)
+        env = dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+        self.proc = subprocess.Popen([self.cmd, 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False'],
+                                     cwd=self.root, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        perf_stats.count('process_spawns', 'hg')
+        channel, hello = self._read_message()
+        if channel != b'o' or b'runcommand' not in hello:
+            raise HgServerError('unexpected hello message: %r' % hello)
+
+    def _stop(self):
+        if self.proc:
+            try:
+                self.proc.stdin.close()
+                self.proc.kill()
+                self.proc.wait()
+            except (IOError, OSError):
+                pass
+            self.proc = None
+
+    def runcommand(self, args):
+        """
+        Returns output (stdout and stderr) of `hg <args>` as bytes.
+        Raises HgServerError if the server isn't usable.
+        """
+        with self.lock:
+            self.last_used = time.time()
+            # e.g. a command waiting for the repository lock
+            self.killed = None
+            watchdog = start_watchdog(vcs_timeout('hg'), self.kill, 'timed out')
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    self._stop()
+                    self._start()
+                data = b'\0'.join(arg.encode('utf-8') for arg in args)
+                self.proc.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+                self.proc.stdin.flush()
+                output = []
+                while True:
+                    channel, data = self._read_message()
+                    if channel in (b'o', b'e'):
+                        output.append(data)
+                    elif channel == b'r':
+                        return b''.join(output)
+                    elif channel in (b'I', b'L'):
+                        self.proc.stdin.write(struct.pack('>I', 0))
+                        self.proc.stdin.flush()
+                    elif channel.isupper():
+                        raise HgServerError('unsupported channel %r' % channel)
+            except (IOError, OSError, struct.error, HgServerError) as e:
+                self._stop()
+                raise HgServerError(self.killed or str(e))
+            finally:
+                if watchdog:
+                    watchdog.cancel()
+
+    def kill(self, reason='closed'):
+        """
+        Kills the process without taking the lock, so a read that blocks in another thread fails
+        """
+        self.killed = reason
+        proc = self.proc
+        if proc:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def close(self, wait=True):
+        """
+        Stops the process. Returns False if it is in use and `wait` is False.
+        """
+        if not self.lock.acquire(wait):
+            return False
+        try:
+            self._stop()
+        finally:
+            self.lock.release()
+        return True
+
+
+hg_servers = ServerRegistry(HgCommandServer, 'hg_cmdserver_idle_timeout')
+
+
 class CommandThread(threading.Thread):
 
-    def __init__(self, command, on_done, working_dir="", fallback_encoding="", console_encoding="", **kwargs):
+    # reasons why a command is stopped before it finishes
+    TIMED_OUT = 'timed out'
+    TOO_LARGE = 'too large to diff'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, command, on_done, working_dir="", fallback_encoding="", console_encoding="", server=None,
+                 line_consumer=None, process=None, env=None, timeout=None, max_output=None, cancellable=False,
+                 **kwargs):
+        """
+        @param line_consumer: object with feed(line), close() and abort(reason) methods (e.g. DiffParser).
+            If it's given, output is decoded and passed to it line by line while the command runs,
+            and on_done receives the consumer instead of the whole output.
+            Exit status of the command is stored in consumer's `returncode` attribute if it has one.
+            If the command is stopped, on_done receives the consumer after abort() has been called.
+        @param process: function that is called with the output (or the line consumer) in the worker thread,
+            its result is passed to on_done on the main thread
+        @param env: variables that are added to the environment of the command
+        @param timeout: time limit in seconds, `vcs_timeouts` setting is used if it's None
+        @param max_output: the command is stopped once its output exceeds this number of bytes
+        @param cancellable: the command only reads the repository, so it may be killed by cancel()
+            when its result isn't needed anymore (see CommandPool.cancel_view)
+        """
         threading.Thread.__init__(self)
         self.command = command
+        self.description = ' '.join(command)
+        self.vcs_name = get_vcs_name(command)
         self.on_done = on_done
+        self.process = process
+        self.env = env
+        self.timeout = vcs_timeout(self.vcs_name) if timeout is None else timeout
+        self.max_output = max_output
+        self.cancellable = cancellable
+        self.lock = threading.Lock()
+        self.proc = None
+        self.aborted = None
+        self.finished = False
+        # threads with the same command that are served by this thread's run (see CommandPool.submit_command)
+        self.followers = []
         self.working_dir = working_dir
+        self.server = server
+        self.line_consumer = line_consumer
         if 'stdin' in kwargs:
             self.stdin = kwargs['stdin'].encode()
         else:
@@ -154,7 +1055,63 @@ class CommandThread(threading.Thread):
         self.fallback_encoding = fallback_encoding
         self.kwargs = kwargs
 
+    def merge_key(self):
+        """
+        Threads with the same key produce the same output, so one run can serve all of them
+        """
+        if self.stdout != subprocess.PIPE:
+            return None
+        return (tuple(self.command), self.working_dir, self.stdin, self.console_encoding, self.fallback_encoding,
+                type(self.line_consumer).__name__, id(self.server), tuple(sorted((self.env or {}).items())))
+
+    def abort(self, reason):
+        """
+        Stops the command and the processes it started.
+        Returns False if the command has already finished or been stopped.
+        """
+        with self.lock:
+            if self.finished or self.aborted is not None:
+                return False
+            self.aborted = reason
+            proc = self.proc
+        log('stop command ({0}):'.format(reason), self.description)
+        if proc is not None:
+            kill_process_tree(proc)
+        return True
+
+    def cancel(self):
+        return self.abort(self.CANCELLED)
+
+    def finish(self):
+        """
+        Marks output as complete, returns the reason if the command has been stopped instead
+        """
+        with self.lock:
+            self.finished = True
+            return self.aborted
+
     def run(self):
+        if self.server:
+            try:
+                with perf_stats.span('vcs', self.vcs_name):
+                    output = self.server.runcommand(['--cwd', self.working_dir] + self.command[1:])
+                perf_stats.count('server_commands', self.vcs_name)
+                aborted = self.finish()
+                if aborted is not None:
+                    return self.report(aborted)
+                with perf_stats.span('decode', self.vcs_name):
+                    output = self.decode(output)
+                if self.line_consumer:
+                    with perf_stats.span('parse', self.vcs_name):
+                        for line in output.splitlines():
+                            self.line_consumer.feed(line)
+                        self.line_consumer.close()
+                    output = self.line_consumer
+                self.done(output)
+                return
+            except HgServerError as e:
+                log('command server failed, running the command directly:', e, debug=False)
+
         try:
             # Per http://bugs.python.org/issue8557 shell=True is required to
             # get $PATH on Windows. Yay portable code.
@@ -163,18 +1120,40 @@ class CommandThread(threading.Thread):
             if self.console_encoding:
                 self.command = [s.encode(self.console_encoding) for s in self.command]
 
-            proc = subprocess.Popen(self.command,
-                                    stdout=self.stdout, stderr=subprocess.STDOUT,
-                                    stdin=subprocess.PIPE,
-                                    cwd=self.working_dir if self.working_dir != '' else None,
-                                    shell=shell, universal_newlines=False)
-            output = proc.communicate(self.stdin)[0]
-            if not output:
-                output = ''
+            if self.aborted is not None:
+                # cancelled while waiting for a worker
+                return
+            with perf_stats.span('spawn', self.vcs_name):
+                proc = spawn(self.command,
+                             stdout=self.stdout, stderr=subprocess.STDOUT,
+                             stdin=subprocess.PIPE,
+                             cwd=self.working_dir if self.working_dir != '' else None,
+                             env=dict(os.environ, **self.env) if self.env else None,
+                             shell=shell, universal_newlines=False)
+            perf_stats.count('process_spawns', self.vcs_name)
+            with self.lock:
+                self.proc = proc
+                aborted = self.aborted
+            if aborted is not None:
+                kill_process_tree(proc)
+            watchdog = start_watchdog(self.timeout, self.abort, self.TIMED_OUT)
+            try:
+                if self.line_consumer:
+                    return self.stream(proc)
+
+                with perf_stats.span('vcs', self.vcs_name):
+                    output = self.read(proc)
+            finally:
+                if watchdog:
+                    watchdog.cancel()
+            aborted = self.finish()
+            if aborted is not None:
+                return self.report(aborted)
             # if sublime's python gets bumped to 2.7 we can just do:
             # output = subprocess.check_output(self.command)
-            main_thread(self.on_done,
-                        _make_text_safeish(output, self.fallback_encoding), **self.kwargs)
+            with perf_stats.span('decode', self.vcs_name):
+                output = self.decode(output)
+            self.done(output)
         except subprocess.CalledProcessError as e:
             main_thread(self.on_done, e.returncode)
         except OSError as e:
@@ -184,6 +1163,309 @@ class CommandThread(threading.Thread):
             else:
                 raise e
 
+    def read(self, proc):
+        """
+        Returns the whole output of the process, or the part read before the command was stopped
+        """
+        if self.stdin:
+            proc.stdin.write(self.stdin)
+        proc.stdin.close()
+        if proc.stdout is None:
+            proc.wait()
+            return b''
+        chunks = []
+        size = 0
+        for chunk in iter(functools.partial(proc.stdout.read, 65536), b''):
+            size += len(chunk)
+            if self.max_output and size > self.max_output:
+                self.abort(self.TOO_LARGE)
+                break
+            chunks.append(chunk)
+        proc.stdout.close()
+        proc.wait()
+        return b''.join(chunks)
+
+    def decode(self, output):
+        """
+        Decodes output of the command, text that can't be decoded doesn't stop it
+        """
+        return _decode_leniently(output, self.fallback_encoding)
+
+    def stream(self, proc):
+        started = time.time()
+        parsing = 0
+        size = 0
+        if self.stdin:
+            proc.stdin.write(self.stdin)
+        proc.stdin.close()
+        for line in iter(proc.stdout.readline, b''):
+            size += len(line)
+            if self.max_output and size > self.max_output:
+                self.abort(self.TOO_LARGE)
+                break
+            line_started = time.time()
+            self.line_consumer.feed(self.decode(line).rstrip('\r\n'))
+            parsing += time.time() - line_started
+        proc.stdout.close()
+        proc.wait()
+        aborted = self.finish()
+        if aborted is not None:
+            return self.report(aborted)
+        if hasattr(self.line_consumer, 'returncode'):
+            self.line_consumer.returncode = proc.returncode
+        self.line_consumer.close()
+        # decoding and parsing are interleaved with reading the output, so VCS time excludes them
+        perf_stats.add('vcs', time.time() - started - parsing, self.vcs_name)
+        perf_stats.add('parse', parsing, self.vcs_name)
+        self.done(self.line_consumer)
+
+    def report(self, reason):
+        """
+        Handles a command that has been stopped. Consumers of diffs are told about it through on_done,
+        the result of other commands is dropped.
+        """
+        perf_stats.count({self.TIMED_OUT: 'timeouts', self.TOO_LARGE: 'oversized_diffs',
+                          self.CANCELLED: 'cancelled_commands'}[reason], self.vcs_name)
+        if reason == self.CANCELLED:
+            return
+        if reason == self.TIMED_OUT:
+            log('command timed out after {0} s:'.format(self.timeout), self.description, debug=False)
+        if self.line_consumer:
+            self.line_consumer.abort(reason)
+            self.done(self.line_consumer)
+        else:
+            main_thread(sublime.status_message, "Modific: '{0}' {1}".format(self.description, reason))
+
+    def done(self, output):
+        for thread in [self] + self.followers:
+            result = output
+            if thread.process:
+                with perf_stats.span('process', self.vcs_name):
+                    result = thread.process(output)
+            main_thread(thread.on_done, result, **thread.kwargs)
+
+
+class CommandPool(object):
+    """
+    Runs VCS jobs on a bounded set of worker threads.
+
+    Jobs are taken from a priority queue, so commands invoked by the user and highlighting
+    of the active view go ahead of background views. Queued jobs of closed views are discarded.
+    Size of the pool is taken from `worker_pool_size` setting.
+
+    At most `repo_concurrency` jobs of the same repository run at once, so a busy repository
+    doesn't take all workers. A command that is already waiting in the queue isn't queued again,
+    the queued one serves both.
+
+    Cancellable commands of a view are stopped, even if they are running, when the view is closed
+    or a newer diff replaces the running one.
+    """
+
+    PRIORITY_USER = 0
+    PRIORITY_ACTIVE = 1
+    PRIORITY_BACKGROUND = 2
+    PRIORITY_WARM_UP = 3
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.workers = 0
+        self.running = 0
+        # repository root -> number of its running jobs
+        self.repo_running = {}
+        # running CommandThread -> id of its view
+        self.active = {}
+        self.waits = deque(maxlen=100)
+        self.discarded = 0
+        self.cancelled = 0
+        self.merged = 0
+        self.stopped = False
+
+    def size(self):
+        return max(1, int(get_settings().get('worker_pool_size', 4)))
+
+    def repo_limit(self):
+        return max(1, int(get_settings().get('repo_concurrency', 3)))
+
+    def submit(self, job, priority=PRIORITY_USER, view_id=None, repo=None):
+        """
+        Adds callable to the queue
+        @param repo: root of the repository the job works with
+        """
+        with self.cond:
+            self._push(job, priority, view_id, repo, None)
+
+    def submit_command(self, thread, priority=PRIORITY_USER, view_id=None, repo=None):
+        """
+        Adds CommandThread to the queue. If the same command is already queued,
+        it runs once and its output is passed to the callbacks of both threads.
+        """
+        key = thread.merge_key()
+        with self.cond:
+            for entry in self.queue:
+                leader = entry[6]
+                if key is not None and leader is not None and leader.merge_key() == key:
+                    leader.followers.append((view_id, thread))
+                    self.merged += 1
+                    if priority < entry[0]:
+                        entry[0] = priority
+                        heapq.heapify(self.queue)
+                    return
+            self._push(thread.run, priority, view_id, repo, thread)
+
+    def _push(self, job, priority, view_id, repo, thread):
+        self.stopped = False
+        heapq.heappush(self.queue, [priority, next(self.counter), view_id, time.time(), job, repo, thread])
+        if self.workers < self.size() and self.workers - self.running < len(self.queue):
+            self.workers += 1
+            worker = threading.Thread(target=self._work, name='Modific worker')
+            worker.daemon = True
+            worker.start()
+        self.cond.notify()
+
+    def _take(self):
+        """
+        Pops the most important job whose repository isn't busy, or returns None
+        """
+        limit = self.repo_limit()
+        skipped = []
+        entry = None
+        while self.queue:
+            candidate = heapq.heappop(self.queue)
+            if candidate[5] is None or self.repo_running.get(candidate[5], 0) < limit:
+                entry = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self.queue, candidate)
+        return entry
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped or self.workers > self.size():
+                        self.workers -= 1
+                        return
+                    entry = self._take()
+                    if entry is not None:
+                        break
+                    self.cond.wait()
+                priority, _, view_id, queued, job, repo, thread = entry
+                if thread is not None:
+                    # followers are stored as (view id, thread) until the job starts
+                    thread.followers = [follower for _, follower in thread.followers]
+                    self.active[thread] = view_id
+                self.waits.append(time.time() - queued)
+                self.running += 1
+                if repo is not None:
+                    self.repo_running[repo] = self.repo_running.get(repo, 0) + 1
+            perf_stats.add('queue', time.time() - queued)
+            try:
+                job()
+            except Exception as e:
+                log('job failed:', e, debug=False)
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    self.active.pop(thread, None)
+                    if repo is not None:
+                        self.repo_running[repo] -= 1
+                        if not self.repo_running[repo]:
+                            del self.repo_running[repo]
+                        # jobs of this repository might be waiting for a free slot
+                        self.cond.notify_all()
+
+    def prioritize(self, view_id, priority):
+        """
+        Moves queued jobs of the view up to the given priority
+        """
+        with self.cond:
+            changed = False
+            for entry in self.queue:
+                if entry[2] == view_id and entry[0] > priority:
+                    entry[0] = priority
+                    changed = True
+            if changed:
+                heapq.heapify(self.queue)
+
+    def discard_view(self, view_id):
+        with self.cond:
+            queue = []
+            for entry in self.queue:
+                thread = entry[6]
+                if thread is not None and thread.followers:
+                    followers = [item for item in thread.followers if item[0] != view_id]
+                    self.discarded += len(thread.followers) - len(followers)
+                    thread.followers = followers
+                    if entry[2] == view_id and followers:
+                        # the command is still needed by other views, so one of them takes it over
+                        follower_view_id, leader = followers[0]
+                        leader.followers = followers[1:]
+                        entry[2], entry[4], entry[6] = follower_view_id, leader.run, leader
+                        self.discarded += 1
+                if entry[2] == view_id:
+                    self.discarded += 1
+                else:
+                    queue.append(entry)
+            if len(queue) != len(self.queue):
+                self.queue = queue
+                heapq.heapify(self.queue)
+        self.cancel_view(view_id)
+
+    def cancel_view(self, view_id):
+        """
+        Stops cancellable commands of the view, both queued and running.
+        Commands that serve other views too are left alone.
+        Returns True if any command has been stopped.
+        """
+        def is_cancellable(thread):
+            return thread is not None and thread.cancellable and not thread.followers
+
+        with self.cond:
+            running = [thread for thread, thread_view_id in self.active.items()
+                       if thread_view_id == view_id and is_cancellable(thread)]
+            queue = [entry for entry in self.queue if entry[2] != view_id or not is_cancellable(entry[6])]
+            stopped = len(self.queue) - len(queue)
+            if stopped:
+                self.queue = queue
+                heapq.heapify(self.queue)
+                self.discarded += stopped
+        for thread in running:
+            if thread.cancel():
+                stopped += 1
+                with self.cond:
+                    self.cancelled += 1
+        return stopped > 0
+
+    def shutdown(self):
+        with self.cond:
+            self.stopped = True
+            self.queue = []
+            running = [thread for thread in self.active if thread.cancellable]
+            self.cond.notify_all()
+        for thread in running:
+            thread.cancel()
+
+    def stats(self):
+        with self.cond:
+            waits = list(self.waits)
+            return {
+                'workers': self.workers,
+                'running': self.running,
+                'queued': len(self.queue),
+                'discarded': self.discarded,
+                'merged': self.merged,
+                'cancelled': self.cancelled,
+                'busy_repos': len(self.repo_running),
+                'avg_wait': sum(waits) / len(waits) if waits else 0,
+                'max_wait': max(waits) if waits else 0
+            }
+
+
+command_pool = CommandPool()
+
 
 class EditViewCommand(sublime_plugin.TextCommand):
 
@@ -212,16 +1494,22 @@ class VcsCommand(object):
         super(VcsCommand, self).__init__(*args, **kwargs)
 
     def log(self, *args, **kwargs):
-        return log(settings=self.settings, *args, **kwargs)
+        return log(*args, **kwargs)
+
+    def get_fallback_encoding(self):
+        view = self.active_view()
+        if view and view.settings().get('fallback_encoding'):
+            return view.settings().get('fallback_encoding').rpartition('(')[2].rpartition(')')[0]
+        return ''
 
     def run_command(self, command, callback=None, show_status=False,
-                    filter_empty_args=True, **kwargs):
+                    filter_empty_args=True, priority=CommandPool.PRIORITY_USER, **kwargs):
         if filter_empty_args:
             command = [arg for arg in command if arg]
         if 'working_dir' not in kwargs:
             kwargs['working_dir'] = self.get_working_dir()
-        if 'fallback_encoding' not in kwargs and self.active_view() and self.active_view().settings().get('fallback_encoding'):
-            kwargs['fallback_encoding'] = self.active_view().settings().get('fallback_encoding').rpartition('(')[2].rpartition(')')[0]
+        if 'fallback_encoding' not in kwargs and self.get_fallback_encoding():
+            kwargs['fallback_encoding'] = self.get_fallback_encoding()
         kwargs['console_encoding'] = self.settings.get('console_encoding')
 
         autosave = self.settings.get('autosave', True)
@@ -230,9 +1518,18 @@ class VcsCommand(object):
         if not callback:
             callback = self.generic_done
 
+        vcs = get_vcs(kwargs['working_dir']) if kwargs['working_dir'] else None
+        if self.settings.get('hg_cmdserver', False) and command[0] == (get_user_command('hg') or 'hg'):
+            if vcs and vcs['name'] == 'hg':
+                kwargs['server'] = hg_servers.get(command[0], vcs['root'])
+        if 'env' not in kwargs:
+            kwargs['env'] = READ_ONLY_ENV.get(get_vcs_name(command))
+
         log('run command:', ' '.join(command))
         thread = CommandThread(command, callback, **kwargs)
-        thread.start()
+        view_id = self.active_view().id() if self.active_view() else None
+        command_pool.submit_command(thread, priority, view_id, vcs and vcs['root'])
+        log('command pool:', command_pool.stats())
 
         if show_status:
             message = kwargs.get('status_message', False) or ' '.join(command)
@@ -312,16 +1609,32 @@ class DiffCommand(VcsCommand):
     """
 
     def run(self, edit):
-        vcs = get_vcs(self.get_working_dir())
+        self.run_diff(self.diff_done)
+
+    def run_diff(self, callback, **kwargs):
+        """
+        Returns True if diff command has been started
+        """
+        command = self.get_diff_command(get_vcs(self.get_working_dir()))
+        if command:
+            self.run_command(command, callback, **kwargs)
+            return True
+        return False
+
+    def get_diff_command(self, vcs, skip_large_files=True):
         filepath = self.view.file_name()
         filename = os.path.basename(filepath)
-        max_file_size = self.settings.get('max_file_size', 1024) * 1024
-        if not os.path.exists(filepath) or os.path.getsize(filepath) > max_file_size:
+        if not os.path.exists(filepath) or (skip_large_files and self.is_large_file()):
             # skip large files
-            return
+            return None
         get_command = getattr(self, '{0}_diff_command'.format(vcs['name']), None)
         if get_command:
-            self.run_command(get_command(filename), self.diff_done)
+            return get_command(filename)
+
+    def is_large_file(self):
+        max_file_size = self.settings.get('max_file_size', 1024) * 1024
+        file_stat = _stat(self.view.file_name())
+        return bool(file_stat) and file_stat[1] > max_file_size
 
     def diff_done(self, result):
         self.log('diff_done', result)
@@ -358,7 +1671,22 @@ class DiffCommand(VcsCommand):
         vcs_options = self.settings.get('vcs_options', {}).get('tf') or ['-format:unified']
         return [get_user_command('tf') or 'tf', 'diff'] + vcs_options + [file_name]
 
-    def get_line_ending(self):
+    def git_base_command(self, file_name):
+        # staged version, because that's what `git diff` compares with
+        return [get_user_command('git') or 'git', 'show', ':./' + file_name]
+
+    def svn_base_command(self, file_name):
+        if file_name.find('@') != -1:
+            file_name += '@'
+        return [get_user_command('svn') or 'svn', 'cat', file_name]
+
+    def bzr_base_command(self, file_name):
+        return [get_user_command('bzr') or 'bzr', 'cat', file_name]
+
+    def hg_base_command(self, file_name):
+        return [get_user_command('hg') or 'hg', 'cat', file_name]
+
+    def get_line_ending(self):
         return '\n'
 
     def join_lines(self, lines):
@@ -391,76 +1719,407 @@ class ShowDiffCommand(DiffCommand, sublime_plugin.TextCommand):
         scratch.sel().add(scratch.line(region).a)
 
 
+class LineRanges(object):
+    """
+    Read-only list of (first, last) line ranges, kept as pairs in an array of ints
+    """
+    __slots__ = ('pairs',)
+
+    def __init__(self, ranges=()):
+        self.pairs = array('i', [line for first_last in ranges for line in first_last])
+
+    def __len__(self):
+        return len(self.pairs) // 2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('line range index out of range')
+        return self.pairs[2 * i], self.pairs[2 * i + 1]
+
+    def __iter__(self):
+        pairs = self.pairs
+        for i in range(0, len(pairs), 2):
+            yield pairs[i], pairs[i + 1]
+
+    def __eq__(self, other):
+        if isinstance(other, LineRanges):
+            return self.pairs == other.pairs
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def memory_size(self):
+        return sys.getsizeof(self.pairs)
+
+
+class Hunks(object):
+    """
+    Hunks of a parsed diff, kept column-wise in arrays of ints.
+
+    Only what highlighting and "Show original part" need is stored: line numbers and counts,
+    kinds of lines ('-', '+' or ' ') of hunks with context lines, and removed lines.
+    Kinds and removed lines of all hunks are joined into two strings, a hunk refers to them by offsets.
+    Zero-context hunks don't store their kinds: removed lines are followed by added ones.
+    """
+    __slots__ = ('starts', 'old_starts', 'old_counts', 'new_counts', 'kind_ends', 'text_ends', 'kinds', 'text')
+
+    # old start of hunks added by DiffParser.apply_edit(), whose original text is unknown
+    LOCAL = -1
+
+    def __init__(self):
+        self.starts = array('i')
+        self.old_starts = array('i')
+        self.old_counts = array('i')
+        self.new_counts = array('i')
+        # ends of every hunk's part of `kinds` and `text`
+        self.kind_ends = array('i')
+        self.text_ends = array('i')
+        self.kinds = ''
+        # removed lines, each of them followed by a newline
+        self.text = ''
+
+    def __len__(self):
+        return len(self.starts)
+
+    def append(self, start, old_start, old_count, new_count, kind_end, text_end):
+        self.starts.append(start)
+        self.old_starts.append(old_start)
+        self.old_counts.append(old_count)
+        self.new_counts.append(new_count)
+        self.kind_ends.append(kind_end)
+        self.text_ends.append(text_end)
+
+    def insert_local(self, i, start, old_count, new_count):
+        """
+        Inserts hunk of added lines, that replaced `old_count` unknown lines
+        """
+        self.starts.insert(i, start)
+        self.old_starts.insert(i, self.LOCAL)
+        self.old_counts.insert(i, old_count)
+        self.new_counts.insert(i, new_count)
+        self.kind_ends.insert(i, self.kind_ends[i - 1] if i else 0)
+        self.text_ends.insert(i, self.text_ends[i - 1] if i else 0)
+
+    def shift(self, first, delta):
+        """
+        Moves hunks from index `first` on by `delta` lines
+        """
+        starts = self.starts
+        for i in range(first, len(starts)):
+            starts[i] += delta
+
+    def is_local(self, i):
+        return self.old_starts[i] == self.LOCAL
+
+    def context_kinds(self, i):
+        """
+        Returns kinds of lines of the hunk, or None if it has no context lines
+        """
+        begin = self.kind_ends[i - 1] if i else 0
+        end = self.kind_ends[i]
+        return self.kinds[begin:end] if end > begin else None
+
+    def get_kinds(self, i):
+        kinds = self.context_kinds(i)
+        if kinds is None:
+            kinds = ('' if self.is_local(i) else '-' * self.old_counts[i]) + '+' * self.new_counts[i]
+        return kinds
+
+    def end(self, i):
+        return self.starts[i] + len(self.get_kinds(i))
+
+    def removed_lines(self, i):
+        begin = self.text_ends[i - 1] if i else 0
+        end = self.text_ends[i]
+        return self.text[begin:end - 1].split('\n') if end > begin else []
+
+    def copy(self):
+        hunks = Hunks()
+        for name in ('starts', 'old_starts', 'old_counts', 'new_counts', 'kind_ends', 'text_ends'):
+            setattr(hunks, name, array('i', getattr(self, name)))
+        hunks.kinds = self.kinds
+        hunks.text = self.text
+        return hunks
+
+    def memory_size(self):
+        return sum(sys.getsizeof(getattr(self, name)) for name in self.__slots__)
+
+
 class DiffParser(object):
-    instance = None
+    re_header = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+    # number of lines before the first hunk that are kept to report errors
+    max_preamble = 100
 
-    def __init__(self, diff):
+    def __init__(self, diff=None):
+        """
+        @param diff: diff text, or None if lines are going to be passed to feed().
+            The text is dropped once it's parsed.
+        """
         self.diff = diff
         self.chunks = None
-        self.__class__.instance = self
+        self.change_starts = None
+        self.header = None
+        # kinds of lines of the current hunk
+        self.hunk_kinds = []
+        # parts of Hunks.kinds and Hunks.text, and their total lengths
+        self.kind_parts = []
+        self.kind_size = 0
+        self.text_parts = []
+        self.text_size = 0
+        self.preamble = []
+        self.line_ranges = None
+        # True if hunks were updated by apply_edit(), so they might not match the output of VCS exactly
+        self.edited = False
+        # reason why the diff command was stopped (see CommandThread.abort)
+        self.aborted = None
+
+    def _append_to_chunks(self, header, kinds):
+        old_start, old_count, start, new_count = header
+        if not new_count:
+            # hunk without new lines refers to the line before the deletion,
+            # but deleted lines are marked on the line after it
+            start += 1
+        kinds = ''.join(kinds)
+        if kinds != '-' * old_count + '+' * new_count:
+            # hunk has context lines (or isn't a zero-context -U0 hunk for another reason)
+            self.kind_parts.append(kinds)
+            self.kind_size += len(kinds)
+        self.chunks.append(start, old_start, old_count, new_count, self.kind_size, self.text_size)
+
+    def feed(self, line):
+        """
+        Parses next line of the diff. Only kinds of lines and removed lines are kept.
+        """
+        if self.chunks is None:
+            self.chunks = Hunks()
+
+        # ignore lines with '\' at the beginning
+        if line.startswith('\\'):
+            return
 
-    def _append_to_chunks(self, start, lines):
-        self.chunks.append({
-            "start": start,
-            "end": start + len(lines),
-            "lines": lines
-        })
+        match = line.startswith('@@') and self.re_header.match(line)
+        if match:
+            if self.header is not None:
+                self._append_to_chunks(self.header, self.hunk_kinds)
+            # omitted count means 1
+            self.header = tuple(int(n) if n is not None else 1 for n in match.groups())
+            self.hunk_kinds = []
+        elif self.header is not None:
+            kind = line[:1]
+            if kind == '-':
+                text = line[1:] + '\n'
+                self.text_parts.append(text)
+                self.text_size += len(text)
+            elif kind != '+':
+                kind = ' '
+            self.hunk_kinds.append(kind)
+        elif len(self.preamble) < self.max_preamble:
+            self.preamble.append(line)
+
+    def close(self):
+        """
+        Finishes parsing of the fed lines
+        """
+        if self.chunks is None:
+            self.chunks = Hunks()
+        if self.header is not None and self.hunk_kinds:
+            self._append_to_chunks(self.header, self.hunk_kinds)
+        self.chunks.kinds = ''.join(self.kind_parts)
+        self.chunks.text = ''.join(self.text_parts)
+        self.header = None
+        self.hunk_kinds = []
+        self.kind_parts = []
+        self.text_parts = []
+        if len(self.chunks):
+            # lines before the first hunk are only needed to report errors
+            self.preamble = []
+
+    def abort(self, reason):
+        """
+        Drops the fed lines, the diff is incomplete
+        """
+        self.aborted = reason
+        self.chunks = Hunks()
+        self.header = None
+        self.hunk_kinds = []
+        self.kind_parts = []
+        self.text_parts = []
+        self.preamble = []
 
     def get_chunks(self):
         if self.chunks is None:
-            self.chunks = []
-            diff = self.diff.strip()
-            if diff:
-                re_header = re.compile(r'^@@[0-9\-, ]+\+(\d+)', re.S)
-                current = None
-                lines = []
-                for line in diff.splitlines():
-                    # ignore lines with '\' at the beginning
-                    if line.startswith('\\'):
-                        continue
-
-                    matches = re.findall(re_header, line)
-                    if matches:
-                        if current is not None:
-                            self._append_to_chunks(current, lines)
-                        current = int(matches[0])
-                        lines = []
-                    elif current:
-                        lines.append(line)
-                if current is not None and lines:
-                    self._append_to_chunks(current, lines)
+            for line in (self.diff or '').strip().splitlines():
+                self.feed(line)
+            self.close()
+            self.diff = None
 
         return self.chunks
 
-    def get_lines_to_hl(self):
+    def get_error(self):
+        """
+        Returns VCS output if it's not a diff (probably an error message)
+        """
+        if not self.get_chunks() and self.preamble:
+            return '\n'.join(self.preamble)
+
+    def memory_size(self):
+        """
+        Returns approximate number of bytes taken by the parsed diff
+        """
+        size = sys.getsizeof(self) + self.get_chunks().memory_size()
+        for ranges in self.line_ranges or ():
+            size += ranges.memory_size()
+        return size
+
+    @staticmethod
+    def _add_range(ranges, first, last):
+        if ranges and ranges[-1][1] + 1 >= first:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+        else:
+            ranges.append((first, last))
+
+    def get_line_ranges_to_hl(self):
+        """
+        Returns inserted, changed and deleted lines as LineRanges of (first, last) tuples,
+        where neighbouring lines of the same kind are merged into one range.
+        The result is computed once.
+        """
+        if self.line_ranges is None:
+            self.line_ranges = tuple(LineRanges(ranges) for ranges in self._classify())
+        return self.line_ranges
+
+    def _classify(self):
         inserted = []
         changed = []
         deleted = []
+        add = self._add_range
+
+        hunks = self.get_chunks()
+        for i in range(len(hunks)):
+            current = hunks.starts[i]
+            kinds = hunks.context_kinds(i)
+            if kinds is None:
+                # removed lines are followed by added ones, so the counts are enough
+                new_count = hunks.new_counts[i]
+                if not hunks.old_counts[i]:
+                    add(inserted, current, current + new_count - 1)
+                elif not new_count:
+                    add(deleted, current, current)
+                else:
+                    add(changed, current, current + new_count - 1)
+                continue
 
-        for chunk in self.get_chunks():
-            current = chunk['start']
-            deleted_line = None
-            for line in chunk['lines']:
-                if line.startswith('-'):
-                    if (not deleted_line or deleted_line not in deleted):
-                        deleted.append(current)
-                    deleted_line = current
-                elif line.startswith('+'):
-                    if deleted_line:
-                        deleted.pop()
-                        deleted_line = None
-                        changed.append(current)
-                    elif current - 1 in changed:
-                        changed.append(current)
+            # removed lines are marked as deleted, unless they are replaced with added lines
+            deletion = False
+            for kind in kinds:
+                if kind == '-':
+                    deletion = True
+                elif kind == '+':
+                    if deletion or (changed and changed[-1][1] == current - 1):
+                        add(changed, current, current)
                     else:
-                        inserted.append(current)
+                        add(inserted, current, current)
+                    deletion = False
                     current += 1
                 else:
-                    deleted_line = None
+                    if deletion:
+                        add(deleted, current, current)
+                    deletion = False
                     current += 1
+            if deletion:
+                add(deleted, current, current)
 
         return inserted, changed, deleted
 
+    def get_lines_to_hl(self):
+        return tuple([line for first, last in ranges for line in range(first, last + 1)]
+                     for ranges in self.get_line_ranges_to_hl())
+
+    def get_change_starts(self):
+        """
+        Returns sorted list of first lines of modified blocks (of any kind)
+        """
+        if self.change_starts is None:
+            ranges = sorted(r for kind in self.get_line_ranges_to_hl() for r in kind)
+            merged = []
+            for r in ranges:
+                self._add_range(merged, *r)
+            self.change_starts = [first for first, last in merged]
+        return self.change_starts
+
+    def get_next_change(self, line_num):
+        starts = self.get_change_starts()
+        i = bisect.bisect_right(starts, line_num)
+        return starts[i] if i < len(starts) else None
+
+    def get_prev_change(self, line_num):
+        starts = self.get_change_starts()
+        i = bisect.bisect_left(starts, line_num)
+        return starts[i - 1] if i > 0 else None
+
+    def copy(self):
+        """
+        Returns parser with its own copy of the parsed hunks, that can be changed by apply_edit()
+        """
+        diff_parser = DiffParser()
+        diff_parser.chunks = self.get_chunks().copy()
+        diff_parser.line_ranges = self.line_ranges
+        diff_parser.edited = self.edited
+        diff_parser.aborted = self.aborted
+        return diff_parser
+
+    def apply_edit(self, first, old_count, new_count):
+        """
+        Updates hunks after lines first..first+old_count-1 of the file were replaced with new_count lines
+        (old_count is 0 if the lines were inserted before line `first`), without diffing the file again:
+        hunks below the edit are shifted, the hunk that contains the edit grows or shrinks, and edited lines outside of hunks are marked as changed.
+
+        Returns False if the edit can't be applied locally
+        (it overlaps several hunks, a deletion or a hunk with context lines).
+        """
+        hunks = self.get_chunks()
+        starts = hunks.starts
+        old_last = first + old_count - 1
+        delta = new_count - old_count
+
+        i = bisect.bisect_left(starts, first)
+        if i and starts[i - 1] + max(hunks.new_counts[i - 1], 1) > first:
+            # edit starts inside of the previous hunk
+            i -= 1
+        j = bisect.bisect_right(starts, old_last, i)
+
+        if i == j:
+            # lines weren't modified before, the original text isn't known, so the hunk is marked as local
+            hunks.insert_local(i, first, old_count, new_count)
+            j = i + 1
+        else:
+            start, hunk_count = starts[i], hunks.new_counts[i]
+            if j - i > 1 or hunks.context_kinds(i) is not None or not hunk_count \
+                    or first < start or old_last >= start + hunk_count:
+                return False
+            hunks.new_counts[i] = hunk_count + delta
+            if not hunks.new_counts[i]:
+                # all added lines are gone
+                return False
+
+        if delta:
+            hunks.shift(j, delta)
+
+        self.change_starts = None
+        self.line_ranges = None
+        self.edited = True
+        return True
+
     def get_original_part(self, line_num):
         """ returns a chunk of code that relates to the given line
             and was there before modifications
@@ -468,23 +2127,32 @@ class DiffParser(object):
             return (lines list, start_line int, replace_lines int)
         """
 
+        hunks = self.get_chunks()
+        # hunks don't overlap in the new file, so only the last few hunks
+        # that start before line_num can contain it
+        i = bisect.bisect_right(hunks.starts, line_num)
+
         # for each chunk from diff:
-        for chunk in self.get_chunks():
+        for n in range(max(0, i - 3), i):
+            if hunks.is_local(n):
+                # original text of lines edited after the last diff is unknown
+                continue
             # if line_num is within that chunk
-            if chunk['start'] <= line_num <= chunk['end']:
+            if hunks.starts[n] <= line_num <= hunks.end(n):
+                removed = iter(hunks.removed_lines(n))
                 ret_lines = []
-                current = chunk['start']  # line number that corresponds to current version of file
+                current = hunks.starts[n]  # line number that corresponds to current version of file
                 first = None  # number of the first line to change
                 replace_lines = 0  # number of lines to change
                 return_this_lines = False  # flag shows whether we can return accumulated lines
-                for line in chunk['lines']:
-                    if line.startswith('-') or line.startswith('+'):
+                for kind in hunks.get_kinds(n):
+                    if kind == '-' or kind == '+':
                         first = first or current
                         if current == line_num:
                             return_this_lines = True
-                        if line.startswith('-'):
+                        if kind == '-':
                             # if line starts with '-' we have previous version
-                            ret_lines.append(line[1:])
+                            ret_lines.append(next(removed))
                         else:
                             # if line starts with '+' we only increment numbers
                             replace_lines += 1
@@ -504,51 +2172,800 @@ class DiffParser(object):
         return None, None, None
 
 
+class DiffStore(object):
+    """
+    Parsed diffs of views, so commands act on the diff of their own view
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parsers = {}
+
+    def get(self, view):
+        with self.lock:
+            return self.parsers.get(view.id())
+
+    def set(self, view, diff_parser):
+        with self.lock:
+            self.parsers[view.id()] = diff_parser
+
+    def forget(self, view):
+        with self.lock:
+            self.parsers.pop(view.id(), None)
+
+
+diff_store = DiffStore()
+
+
+class CacheBudget(object):
+    """
+    Memory limit shared by several LruCaches, taken from a setting in KB.
+    While the caches take more memory together, the least recently used entry of all of them is evicted.
+    The caches share the budget's lock.
+    """
+
+    def __init__(self, setting, default):
+        self.setting = setting
+        self.default = default
+        self.lock = threading.RLock()
+        self.caches = []
+        self.used = 0
+        self.evicted = 0
+        self.ticks = itertools.count()
+
+    def enforce(self):
+        """
+        Must be called with the lock held
+        """
+        limit = get_settings().get(self.setting, self.default) * 1024
+        while limit and self.used > limit:
+            caches = [cache for cache in self.caches if cache.entries]
+            if not caches:
+                break
+            min(caches, key=lambda cache: cache.oldest_tick()).evict_oldest()
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {'used': self.used, 'evicted': self.evicted}
+
+
+class LruCache(object):
+    """
+    Thread-safe LRU cache, keyed by tuples whose first item is a file name.
+    A file has only one entry at a time: storing a new one drops the outdated entries.
+    With a CacheBudget, memory taken by the entries (as measured by `sizeof`) is limited too.
+    """
+
+    def __init__(self, size_setting, default_size, budget=None, sizeof=sys.getsizeof):
+        self.size_setting = size_setting
+        self.default_size = default_size
+        self.budget = budget
+        self.sizeof = sizeof
+        self.lock = budget.lock if budget else threading.Lock()
+        # key -> (value, size in bytes, tick of the last use)
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        if budget:
+            budget.caches.append(self)
+
+    def _tick(self):
+        return next(self.budget.ticks) if self.budget else 0
+
+    def _remove(self, key):
+        size = self.entries.pop(key)[1]
+        self.memory -= size
+        if self.budget:
+            self.budget.used -= size
+
+    def oldest_tick(self):
+        return next(iter(self.entries.values()))[2]
+
+    def evict_oldest(self):
+        self._remove(next(iter(self.entries)))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value, size, tick = self.entries.pop(key)
+                self.entries[key] = (value, size, self._tick())
+                return value
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        size = get_settings().get(self.size_setting, self.default_size)
+        memory = self.sizeof(value)
+        with self.lock:
+            for old_key in [k for k in self.entries if k[0] == key[0]]:
+                self._remove(old_key)
+            self.entries[key] = (value, memory, self._tick())
+            self.memory += memory
+            if self.budget:
+                self.budget.used += memory
+            while len(self.entries) > size:
+                self.evict_oldest()
+            if self.budget:
+                self.budget.enforce()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'memory': self.memory}
+
+
+def diff_cache_key(file_name, vcs, command):
+    """
+    Cached diff is valid while file's mtime and size, repository state and the diff command are the same
+    """
+    file_stat = _stat(file_name)
+    repo_state = get_repo_state(vcs)
+    if file_stat is None or repo_state is None:
+        return None
+    return file_name, file_stat, repo_state, tuple(command)
+
+
+def classified_diff_size(diff_parser):
+    # lines of a cached diff are classified when it is highlighted, so their ranges are counted up front
+    diff_parser.get_line_ranges_to_hl()
+    return diff_parser.memory_size()
+
+
+cache_budget = CacheBudget('cache_memory_budget', 65536)
+# parsed diffs
+diff_cache = LruCache('diff_cache_size', 500, cache_budget, classified_diff_size)
+# original (committed or staged) versions of files, used to diff unsaved buffers
+base_cache = LruCache('base_cache_size', 50, cache_budget)
+
+
+def parse_git_status(output):
+    """
+    Parses output of `git status --porcelain=v2 -z`
+
+    Returns OrderedDict {path relative to the root: two-letter status code}
+    """
+    files = OrderedDict()
+    entries = iter(output.split('\0'))
+    for entry in entries:
+        kind = entry[:1]
+        if kind == '1':
+            parts = entry.split(' ', 8)
+        elif kind == '2':
+            parts = entry.split(' ', 9)
+            next(entries, None)  # original path of renamed file
+        elif kind == 'u':
+            parts = entry.split(' ', 10)
+        elif kind in ('?', '!'):
+            files[entry[2:]] = kind * 2
+            continue
+        else:
+            continue
+        files[parts[-1]] = parts[1]
+    return files
+
+
+class GitStatusCache(object):
+    """
+    Snapshot of `git status` of every repository, refreshed in the background.
+
+    A snapshot is used while the repository state (HEAD, index) stays the same.
+    A file that is not in the snapshot and wasn't modified since it was taken
+    has no changes, so it doesn't have to be diffed.
+    """
+
+    # files modified less than this number of seconds before the snapshot might be missing from it
+    mtime_margin = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        # root -> callbacks waiting for the running refresh
+        self.pending = {}
+
+    def get(self, vcs):
+        """
+        Returns up-to-date snapshot {'files': .., 'started': .., 'state': .., 'dirty': ..} or None
+        """
+        snapshot = self.snapshots.get(vcs['root'])
+        if snapshot and snapshot['state'] == get_repo_state(vcs):
+            return snapshot
+        return None
+
+    def is_clean(self, vcs, file_name):
+        """
+        Returns True if file is known to have no changes.
+        Starts refreshing the snapshot if it's outdated.
+        """
+        snapshot = self.get(vcs)
+        if not snapshot:
+            self.refresh(vcs)
+            return False
+        file_stat = _stat(file_name)
+        if not file_stat or file_stat[0] > snapshot['started'] - self.mtime_margin:
+            return False
+        path = os.path.relpath(os.path.realpath(file_name), os.path.realpath(vcs['root']))
+        return path.replace(os.sep, '/') not in snapshot['files']
+
+    def touch(self, vcs):
+        """
+        Marks snapshot as incomplete (e.g. after a file was saved), it's refreshed when it's needed next time
+        """
+        snapshot = self.snapshots.get(vcs['root'])
+        if snapshot:
+            snapshot['dirty'] = True
+
+    def refresh(self, vcs, callback=None, priority=CommandPool.PRIORITY_BACKGROUND):
+        """
+        Takes a new snapshot in a worker thread, callback receives it on the main thread
+        """
+        with self.lock:
+            if vcs['root'] in self.pending:
+                # already running, just wait for it
+                if callback:
+                    self.pending[vcs['root']].append(callback)
+                return
+            self.pending[vcs['root']] = [callback] if callback else []
+        command_pool.submit(functools.partial(self._refresh, dict(vcs)), priority, repo=vcs['root'])
+
+    def _refresh(self, vcs):
+        snapshot = None
+        try:
+            started = time.time()
+            state = get_repo_state(vcs)
+            command = [get_user_command('git') or 'git', 'status', '--porcelain=v2', '-z']
+            log('run command:', ' '.join(command))
+            # don't let git status refresh the index, that would change the repository state
+            output = vcs_output(command, vcs['root'], env=READ_ONLY_ENV['git'])
+            if output is not None:
+                snapshot = {
+                    # paths aren't necessarily valid UTF-8
+                    'files': parse_git_status(output.decode('utf-8', 'replace')),
+                    'started': started,
+                    'state': state,
+                    'dirty': False
+                }
+        finally:
+            # callbacks must run even if the refresh failed, later refreshes wait for this one otherwise
+            with self.lock:
+                if snapshot:
+                    self.snapshots[vcs['root']] = snapshot
+                callbacks = self.pending.pop(vcs['root'], [])
+            for callback in callbacks:
+                main_thread(callback, snapshot)
+
+
+git_status_cache = GitStatusCache()
+
+
+def unified_diff(original, current, context=3):
+    """
+    In-process replacement for VCS diff command, produces output that DiffParser understands
+    """
+    return '\n'.join(difflib.unified_diff(original.splitlines(), current.splitlines(), n=context, lineterm=''))
+
+
+def build_regions(view, lines):
+    """
+    Returns empty regions at the beginning of every line of the (first, last) line ranges
+    """
+    regions = []
+    for first, last in lines:
+        begin = view.text_point(first - 1, 0)
+        if first == last:
+            regions.append(sublime.Region(begin, begin))
+        else:
+            lines_region = sublime.Region(begin, view.text_point(last - 1, 0))
+            regions.extend(sublime.Region(line.a, line.a) for line in view.lines(lines_region))
+    return regions
+
+
+def hl_lines(view, lines, hl_key, settings, regions=None):
+    """
+    @param lines: list of (first, last) line ranges
+    @param regions: regions of the lines, if they are already built
+    """
+    if (not len(lines) or not settings.get('highlight_changes')):
+        view.erase_regions(hl_key)
+        return
+
+    icon = settings.get('region_icon') or 'modific'
+    if icon == 'none':
+        return
+
+    if icon == 'modific':
+        if IS_ST3:
+            icon = 'Packages/Modific/icons/' + hl_key + '.png'
+        else:
+            icon = '../Modific/icons/' + hl_key
+    with perf_stats.span('paint'):
+        if regions is None:
+            regions = build_regions(view, lines)
+        view.add_regions(hl_key, regions, "markup.%s.diff" % hl_key, icon, sublime.HIDDEN | sublime.DRAW_EMPTY)
+
+
+class RegionPainter(object):
+    """
+    Highlights line ranges of a view on the main thread without blocking it for long.
+
+    Regions are built in slices of at most `hl_main_thread_budget` ms, one slice per main loop tick,
+    and added to the view all at once when they are ready. A new paint of the view cancels the previous one.
+    """
+
+    # number of ranges between checks of the time
+    slice_size = 64
+
+    def __init__(self):
+        self.jobs = {}
+
+    def paint(self, view, ranges, settings):
+        job = {'keys': ('inserted', 'changed', 'deleted'), 'ranges': ranges, 'regions': [[], [], []],
+               'kind': 0, 'index': 0}
+        self.jobs[view.id()] = job
+        self._step(view, job, settings)
+
+    def cancel(self, view):
+        """
+        Returns True if painting of the view was in progress
+        """
+        return self.jobs.pop(view.id(), None) is not None
+
+    def _step(self, view, job, settings):
+        if self.jobs.get(view.id()) is not job:
+            return
+        if not view.is_valid():
+            self.jobs.pop(view.id(), None)
+            return
+
+        with perf_stats.span('main_thread'):
+            deadline = time.time() + settings.get('hl_main_thread_budget', 10) / 1000.0
+            while job['kind'] < 3:
+                lines = job['ranges'][job['kind']]
+                if job['index'] >= len(lines):
+                    job['kind'] += 1
+                    job['index'] = 0
+                    continue
+                end = job['index'] + self.slice_size
+                job['regions'][job['kind']].extend(build_regions(view, lines[job['index']:end]))
+                job['index'] = end
+                if time.time() > deadline:
+                    perf_stats.count('paint_slices')
+                    sublime.set_timeout(functools.partial(self._step, view, job, settings), 0)
+                    return
+
+            del self.jobs[view.id()]
+            for hl_key, lines, regions in zip(job['keys'], job['ranges'], job['regions']):
+                hl_lines(view, lines, hl_key, settings, regions)
+
+
+region_painter = RegionPainter()
+
+
+class ViewportHighlighter(object):
+    """
+    Highlights large files only around the visible area.
+
+    Line ranges of the whole diff are kept, but regions are added only for lines
+    within one screen above and below the viewport, and at most `large_file_max_regions` of each kind.
+    While such a view is active, it is checked for scrolling every 200 ms,
+    less often while it doesn't scroll. Checks stop when another view is activated.
+    """
+
+    # ms between checks for scrolling, the interval doubles up to the maximum while the view stays still
+    poll_interval = 200
+    max_poll_interval = 1600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.polling = False
+
+    def set(self, view, ranges, settings):
+        with self.lock:
+            self.views[view.id()] = {
+                'ranges': ranges,
+                # last lines of the ranges, to bisect them
+                'ends': [[last for first, last in kind] for kind in ranges],
+                'painted': None,
+                'visible': None
+            }
+        self.update(view, settings)
+        self.resume(view)
+
+    def resume(self, view):
+        """
+        Starts checking the view for scrolling if it is highlighted around the viewport
+        """
+        with self.lock:
+            if self.polling or view.id() not in self.views:
+                return
+            self.polling = True
+        sublime.set_timeout(functools.partial(self.poll, self.poll_interval), self.poll_interval)
+
+    def forget(self, view):
+        with self.lock:
+            self.views.pop(view.id(), None)
+
+    def has(self, view):
+        return view.id() in self.views
+
+    def update(self, view, settings=None):
+        """
+        Returns True if the view was scrolled since the last update
+        """
+        state = self.views.get(view.id())
+        if not state:
+            return False
+        visible = view.visible_region()
+        first = view.rowcol(visible.begin())[0] + 1
+        last = view.rowcol(visible.end())[0] + 1
+        scrolled = state['visible'] != (first, last)
+        state['visible'] = (first, last)
+        painted = state['painted']
+        if painted and painted[0] <= first and last <= painted[1]:
+            return scrolled
+
+        settings = settings or get_settings()
+        budget = settings.get('large_file_max_regions', 3000)
+        margin = last - first + 1
+        window = (max(1, first - margin), last + margin)
+        clipped, overflow = self._clip(state, window, budget)
+        if overflow:
+            # too many changes around, so paint only what is on the screen
+            window = (first, last)
+            clipped, overflow = self._clip(state, window, budget)
+
+        for hl_key, lines in zip(('inserted', 'changed', 'deleted'), clipped):
+            hl_lines(view, lines, hl_key, settings)
+        state['painted'] = window
+        return scrolled
+
+    @staticmethod
+    def _clip(state, window, max_regions):
+        """
+        Returns ranges that are within the window,
+        and whether some were left out to stay within the budget of regions of each kind
+        """
+        clipped = []
+        overflow = False
+        for ranges, ends in zip(state['ranges'], state['ends']):
+            budget = max_regions
+            lines = []
+            i = bisect.bisect_left(ends, window[0])
+            while i < len(ranges) and ranges[i][0] <= window[1]:
+                if budget <= 0:
+                    overflow = True
+                    break
+                start, end = max(ranges[i][0], window[0]), min(ranges[i][1], window[1])
+                if end - start + 1 > budget:
+                    end = start + budget - 1
+                    overflow = True
+                lines.append((start, end))
+                budget -= end - start + 1
+                i += 1
+            clipped.append(lines)
+        return clipped, overflow
+
+    def poll(self, interval):
+        window = sublime.active_window()
+        view = window and window.active_view()
+        with self.lock:
+            # on_activated of a large file starts the checks again
+            self.polling = bool(view) and view.id() in self.views
+            if not self.polling:
+                return
+        if self.update(view):
+            interval = self.poll_interval
+        else:
+            interval = min(interval * 2, self.max_poll_interval)
+        sublime.set_timeout(functools.partial(self.poll, interval), interval)
+
+
+viewport_highlighter = ViewportHighlighter()
+
+
+class MultiFileDiffParser(object):
+    """
+    Splits output of a diff command for several files into a DiffParser per file.
+    Works as a line consumer of CommandThread.
+    """
+
+    def __init__(self, vcs_name):
+        self.file_header = 'Index: ' if vcs_name == 'svn' else 'diff '
+        self.strip_prefix = vcs_name != 'svn'
+        self.parsers = {}
+        self.current = None
+        self.path = None
+        self.aborted = None
+        self.returncode = None
+        # lines before the first file, they are only expected if the command failed
+        self.preamble = []
+        # number of files whose path couldn't be read from the output
+        self.unmatched = 0
+
+    def feed(self, line):
+        if line.startswith(self.file_header):
+            self._finish()
+            self.current = DiffParser()
+            return
+        if self.current is None:
+            if len(self.preamble) < DiffParser.max_preamble:
+                self.preamble.append(line)
+            return
+        if self.path is None and self.current.header is None and line.startswith('+++ '):
+            path = line[4:].split('\t')[0]
+            if self.strip_prefix and path.startswith('b/'):
+                path = path[2:]
+            if path != '/dev/null' and not path.startswith('"'):
+                # quoted (C-style escaped) paths are left unmatched
+                self.path = path
+        self.current.feed(line)
+
+    def _finish(self):
+        if self.current is not None:
+            self.current.close()
+            if self.path is not None:
+                self.parsers[self.path] = self.current
+            else:
+                self.unmatched += 1
+        self.current = None
+        self.path = None
+
+    def close(self):
+        self._finish()
+
+    def abort(self, reason):
+        self.aborted = reason
+        self.parsers = {}
+        self.current = None
+        self.path = None
+
+    def get_error(self):
+        """
+        Returns error message if the command failed, then missing files aren't necessarily clean
+        """
+        if self.returncode or self.preamble:
+            return '\n'.join(self.preamble) or 'exit status {0}'.format(self.returncode)
+
+
+class PreparedDiff(object):
+    """
+    Diff that has been parsed and classified in a worker thread.
+    Regions are built in advance too if the view API can be used off the main thread,
+    they are valid while the view's change count stays the same.
+    """
+
+    def __init__(self, diff_parser, regions=None, change_count=None):
+        self.diff_parser = diff_parser
+        self.regions = regions
+        self.change_count = change_count
+
+
 class HlChangesCommand(DiffCommand, sublime_plugin.TextCommand):
+    # options that make diff commands skip context lines
+    zero_context_options = {
+        'git': ['-U0'],
+        'hg': ['-U', '0']
+    }
+
+    def get_diff_command(self, vcs, skip_large_files=True):
+        # large files are highlighted only around the visible area
+        skip_large_files = skip_large_files and not self.settings.get('large_file_viewport_highlight', True)
+        command = super(HlChangesCommand, self).get_diff_command(vcs, skip_large_files)
+        if command and vcs['name'] == 'git' and command[1] == 'diff':
+            # porcelain "git diff" refreshes the index even with GIT_OPTIONAL_LOCKS=0,
+            # the plumbing equivalent only reads it
+            command = command[:1] + ['diff-files', '-p'] + command[2:]
+        options = self.zero_context_options.get(vcs['name'])
+        if command and options and self.settings.get('hl_zero_context', True):
+            # highlighting doesn't need context lines, so don't make VCS produce them
+            command = command[:2] + options + command[2:]
+        return command
+
     def hl_lines(self, lines, hl_key):
-        if (not len(lines) or not self.settings.get('highlight_changes')):
-            self.view.erase_regions(hl_key)
+        hl_lines(self.view, lines, hl_key, self.settings)
+
+    def is_enabled(self, generation=None, live=False):
+        enabled = super(HlChangesCommand, self).is_enabled()
+        if not enabled and generation is not None:
+            # command won't run, so release the scheduler slot right away
+            hl_scheduler.done(self.view, generation)
+        return enabled
+
+    def run(self, edit, generation=None, live=False):
+        """
+        @param live: diff unsaved buffer in memory even if `live_highlight` is off
+        """
+        started = time.time()
+        if generation is None:
+            generation = hl_scheduler.begin(self.view)
+        window = self.view.window()
+        if window and window.active_view() and window.active_view().id() == self.view.id():
+            priority = CommandPool.PRIORITY_ACTIVE
+        else:
+            priority = CommandPool.PRIORITY_BACKGROUND
+
+        vcs = get_vcs(self.get_working_dir())
+        if self.view.is_dirty() and (live or self.settings.get('live_highlight', False)):
+            if not self.run_live_diff(vcs, generation, priority, started):
+                hl_scheduler.done(self.view, generation)
             return
 
-        icon = self.settings.get('region_icon') or 'modific'
-        if icon == 'none':
+        command = self.get_diff_command(vcs)
+        if not command:
+            hl_scheduler.done(self.view, generation)
             return
 
-        if icon == 'modific':
-            if IS_ST3:
-                icon = 'Packages/Modific/icons/' + hl_key + '.png'
-            else:
-                icon = '../Modific/icons/' + hl_key
-        points = [self.view.text_point(l - 1, 0) for l in lines]
-        regions = [sublime.Region(p, p) for p in points]
-        self.view.add_regions(hl_key, regions, "markup.%s.diff" % hl_key, icon, sublime.HIDDEN | sublime.DRAW_EMPTY)
+        cache_key = None
+        if not (self.view.is_dirty() and self.settings.get('autosave', True)):
+            # file is going to be saved before the diff, so its current stat is of no use
+            cache_key = diff_cache_key(self.view.file_name(), vcs, command)
+        diff_parser = cache_key and diff_cache.get(cache_key)
+        if not diff_parser and cache_key and vcs['name'] == 'git' and self.settings.get('git_status_cache', True) \
+                and git_status_cache.is_clean(vcs, self.view.file_name()):
+            self.log('file is clean according to git status:', self.view.file_name())
+            diff_parser = DiffParser('')
+            diff_cache.set(cache_key, diff_parser)
+        if diff_parser:
+            self.log('diff cache hit:', self.view.file_name(), diff_cache.stats())
+            perf_stats.count('diff_cache_hits', vcs['name'])
+            if hl_scheduler.done(self.view, generation):
+                with perf_stats.span('main_thread'):
+                    self.highlight(diff_parser)
+                perf_stats.add('hl_changes_cached', time.time() - started, vcs['name'])
+            return
 
-    def diff_done(self, diff):
-        self.log('on hl_changes:', diff)
+        perf_stats.count('diff_cache_misses', vcs['name'])
+        self.run_command(command, functools.partial(self.diff_done, generation=generation, cache_key=cache_key,
+                                                    timing=('hl_changes', vcs['name'], started)),
+                         priority=priority, line_consumer=DiffParser(), process=self.prepare,
+                         max_output=self.max_diff_output(), cancellable=True)
 
-        if diff and '@@' not in diff:
-            # probably this is an error message
-            # if print raise UnicodeEncodeError, try to encode string to utf-8 (issue #35)
-            try:
-                print(diff)
-            except UnicodeEncodeError:
-                print(diff.encode('utf-8'))
+    def max_diff_output(self):
+        return self.settings.get('max_diff_output', 20480) * 1024 or None
+
+    def run_live_diff(self, vcs, generation, priority, started=None):
+        """
+        Diffs unsaved buffer against the original version of the file without touching the disk.
+        Returns True if diff has been started.
+        """
+        get_command = getattr(self, '{0}_base_command'.format(vcs['name']), None)
+        max_file_size = self.settings.get('max_file_size', 1024) * 1024
+        if not get_command or self.view.size() > max_file_size:
+            return False
+
+        file_name = self.view.file_name()
+        job = functools.partial(self.live_diff, vcs, file_name, get_command(os.path.basename(file_name)),
+                                self.view.substr(sublime.Region(0, self.view.size())), generation,
+                                self.get_fallback_encoding(), started or time.time())
+        command_pool.submit(job, priority, self.view.id(), vcs['root'])
+        return True
+
+    def live_diff(self, vcs, file_name, command, text, generation, fallback_encoding, started=None):
+        """
+        Runs in a worker thread
+        """
+        finished = False
+        try:
+            self._live_diff(vcs, file_name, command, text, generation, fallback_encoding, started)
+            finished = True
+        finally:
+            if not finished:
+                # otherwise the view's requests would wait for this diff until `in_flight_timeout`
+                hl_scheduler.done(self.view, generation)
+
+    def _live_diff(self, vcs, file_name, command, text, generation, fallback_encoding, started):
+        repo_state = get_repo_state(vcs)
+        base = base_cache.get((file_name, repo_state)) if repo_state else None
+        if base is None:
+            if vcs['name'] == 'git' and self.settings.get('git_cat_file', True):
+                path = os.path.relpath(os.path.realpath(file_name), os.path.realpath(vcs['root']))
+                output = git_cat_file.get(command[0], vcs['root']).get(':' + path.replace(os.sep, '/'))
+            else:
+                log('run command:', ' '.join(command))
+                output = vcs_output(command, os.path.dirname(file_name), self.settings.get('console_encoding'),
+                                    READ_ONLY_ENV.get(vcs['name']))
+            # False means that the file is not under version control
+            base = False if output is None else _decode_leniently(output, fallback_encoding).replace('\r\n', '\n')
+            if repo_state:
+                base_cache.set((file_name, repo_state), base)
+
+        context = 0 if self.settings.get('hl_zero_context', True) else 3
+        with perf_stats.span('difflib', vcs['name']):
+            diff = unified_diff(base, text, context) if base is not False else ''
+        with perf_stats.span('process', vcs['name']):
+            prepared = self.prepare(diff)
+        main_thread(self.diff_done, prepared, generation=generation, timing=('live_diff', vcs['name'], started))
+
+    def prepare(self, diff):
+        """
+        Runs in a worker thread: parses and classifies the diff, so the main thread only adds regions
+        """
+        diff_parser = diff if isinstance(diff, DiffParser) else DiffParser(diff)
+        if diff_parser.diff is not None:
+            self.log('on hl_changes:', diff_parser.diff)
+        else:
+            self.log('on hl_changes:', len(diff_parser.get_chunks()), 'hunks')
+        if diff_parser.get_error():
+            return PreparedDiff(diff_parser)
+
+        with perf_stats.span('classify'):
+            ranges = diff_parser.get_line_ranges_to_hl()
+        if not IS_ST3 or not self.settings.get('highlight_changes') or self.is_large_file():
+            # ST2 API can be used only on the main thread, large files are painted around the viewport
+            return PreparedDiff(diff_parser)
+        change_count = self.view.change_count()
+        regions = [build_regions(self.view, lines) for lines in ranges]
+        if self.view.change_count() != change_count:
+            return PreparedDiff(diff_parser)
+        return PreparedDiff(diff_parser, regions, change_count)
+
+    def diff_done(self, diff, generation=None, cache_key=None, timing=None):
+        """
+        @param diff: PreparedDiff, or diff text or DiffParser that haven't been prepared yet
+        @param timing: (stage, vcs name, start time) tuple, time of the whole round trip is added to that stage
+        """
+        if generation is not None and not hl_scheduler.done(self.view, generation):
+            self.log('skip outdated diff for', self.view.file_name())
+            perf_stats.count('outdated_diffs', timing and timing[1])
+            return
 
-        diff_parser = DiffParser(diff)
-        (inserted, changed, deleted) = diff_parser.get_lines_to_hl()
+        with perf_stats.span('main_thread'):
+            prepared = diff if isinstance(diff, PreparedDiff) else self.prepare(diff)
+            diff_parser = prepared.diff_parser
+            error = diff_parser.get_error()
+            if error:
+                # probably this is an error message
+                # if print raise UnicodeEncodeError, try to encode string to utf-8 (issue #35)
+                try:
+                    print(error)
+                except UnicodeEncodeError:
+                    print(error.encode('utf-8'))
+            elif cache_key and diff_parser.aborted != CommandThread.TIMED_OUT:
+                # a file that is too large to diff stays so until it or the repository changes
+                diff_cache.set(cache_key, diff_parser)
+            self.highlight(diff_parser, prepared)
+        if timing and timing[2]:
+            perf_stats.add(timing[0], time.time() - timing[2], timing[1])
+
+    def highlight(self, diff_parser, prepared=None):
+        # queued edits of the previous diff are dropped before the new one is published
+        edit_tracker.reset(self.view)
+        diff_store.set(self.view, diff_parser)
+        if diff_parser.aborted:
+            self.view.set_status('modific', 'Modific: ' + diff_parser.aborted)
+        else:
+            self.view.erase_status('modific')
+        (inserted, changed, deleted) = ranges = diff_parser.get_line_ranges_to_hl()
 
         self.log('new lines:', inserted)
         self.log('modified lines:', changed)
         self.log('deleted lines:', deleted)
 
-        self.hl_lines(inserted, 'inserted')
-        self.hl_lines(deleted, 'deleted')
-        self.hl_lines(changed, 'changed')
+        if self.is_large_file():
+            region_painter.cancel(self.view)
+            viewport_highlighter.set(self.view, ranges, self.settings)
+            return
+        viewport_highlighter.forget(self.view)
+
+        if prepared and prepared.regions is not None and self.view.change_count() == prepared.change_count:
+            # regions were built in the worker, adding them takes constant time
+            region_painter.cancel(self.view)
+            for hl_key, lines, regions in zip(('inserted', 'changed', 'deleted'), ranges, prepared.regions):
+                hl_lines(self.view, lines, hl_key, self.settings, regions)
+        else:
+            region_painter.paint(self.view, ranges, self.settings)
 
 
 class ShowOriginalPartCommand(DiffCommand, sublime_plugin.TextCommand):
     def run(self, edit):
-        diff_parser = DiffParser.instance
+        diff_parser = diff_store.get(self.view)
         if not diff_parser:
             return
 
@@ -562,7 +2979,7 @@ class ReplaceModifiedPartCommand(DiffCommand, sublime_plugin.TextCommand):
     def run(self, edit):
         self.view.run_command('save')
 
-        diff_parser = DiffParser.instance
+        diff_parser = diff_store.get(self.view)
         if not diff_parser:
             return
 
@@ -587,51 +3004,912 @@ class ReplaceModifiedPartCommand(DiffCommand, sublime_plugin.TextCommand):
             self.view.run_command('save')
 
 
+class HlScheduler(object):
+    """
+    Coalesces bursts of hl_changes requests for a view.
+
+    Requests are debounced by `hl_changes_delay` ms and at most one diff per view is in flight.
+    A running VCS diff is killed when a newer request fires, other requests that arrive
+    while a diff is running are merged into one follow-up run.
+    Every request bumps the view's generation, so results of outdated diffs are dropped.
+    """
+
+    # a diff that didn't report back within this time (in seconds) no longer blocks the view
+    in_flight_timeout = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def _state(self, view):
+        return self.views.setdefault(view.id(), {'generation': 0, 'in_flight': None,
+                                                 'started': 0, 'pending': False, 'live': False})
+
+    def schedule(self, view, delay=None, live=False):
+        """
+        @param live: diff unsaved buffer in memory (see HlChangesCommand.run)
+        """
+        with self.lock:
+            state = self._state(view)
+            state['generation'] += 1
+            state['live'] = live
+            generation = state['generation']
+        if delay is None:
+            delay = get_settings().get('hl_changes_delay', 100)
+        sublime.set_timeout(functools.partial(self._fire, view, generation), delay)
+
+    def _fire(self, view, generation):
+        with self.lock:
+            state = self.views.get(view.id())
+            if not state or state['generation'] != generation:
+                # superseded by a newer request
+                return
+            busy = state['in_flight'] is not None and time.time() - state['started'] < self.in_flight_timeout
+        # the command pool lock is never taken while holding the scheduler's one
+        cancelled = busy and command_pool.cancel_view(view.id())
+        with self.lock:
+            state = self.views.get(view.id())
+            if not state or state['generation'] != generation:
+                return
+            if busy and not cancelled and state['in_flight'] is not None:
+                # the running diff starts a follow-up run when it is finished
+                state['pending'] = True
+                return
+            state['in_flight'] = generation
+            state['started'] = time.time()
+            state['pending'] = False
+            args = {'generation': generation}
+            if state['live']:
+                args['live'] = True
+        if hasattr(view, 'is_valid') and not view.is_valid():
+            return self.forget(view)
+        view.run_command('hl_changes', args)
+
+    def begin(self, view):
+        """
+        Registers a request that doesn't go through the scheduler (e.g. direct hl_changes command)
+        and returns its generation
+        """
+        with self.lock:
+            state = self._state(view)
+            state['generation'] += 1
+            return state['generation']
+
+    def done(self, view, generation):
+        """
+        Marks diff as finished and returns True if its result is still up-to-date
+        """
+        with self.lock:
+            state = self.views.get(view.id())
+            if not state:
+                return False
+            rerun = False
+            if state['in_flight'] == generation:
+                state['in_flight'] = None
+                rerun = state['pending']
+                state['pending'] = False
+            current = state['generation']
+        if rerun:
+            sublime.set_timeout(functools.partial(self._fire, view, current), 0)
+        return current == generation
+
+    def has(self, view):
+        """
+        Returns True if highlighting of the view has been requested since it was opened
+        """
+        with self.lock:
+            return view.id() in self.views
+
+    def invalidate(self, view):
+        """
+        Makes result of the running diff outdated because the buffer has been changed since it started.
+        The buffer is diffed in memory once the running diff is finished.
+        """
+        with self.lock:
+            state = self.views.get(view.id())
+            if state and state['in_flight'] is not None:
+                state['generation'] += 1
+                state['pending'] = True
+                state['live'] = True
+
+    def forget(self, view):
+        with self.lock:
+            self.views.pop(view.id(), None)
+
+
+hl_scheduler = HlScheduler()
+
+
+class EditTracker(object):
+    """
+    Keeps highlighting of unsaved views up to date without running diffs.
+
+    Position of an edit is found from the cursor before and after it and the change of the number of lines.
+    The edit is applied to a copy of the view's parsed diff (DiffParser.apply_edit) in the background.
+    Sublime Text moves existing regions along with the text itself,
+    so only kinds of marks that changed beyond that shift are repainted, once the pending edits are applied.
+    If the edit can't be located (several cursors, a selection, the cursor line didn't change)
+    or applied, the buffer is diffed in memory instead.
+    """
+
+    kinds = ('inserted', 'changed', 'deleted')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # view id -> state of the view:
+        #   rows, change_count, cursor - the buffer after the last edit, used on the main thread only
+        #   epoch - incremented when edits that are still queued must not be applied
+        #   applied - change count of the last applied edit, dirty - kinds of marks to repaint
+        self.views = {}
+
+    def count_rows(self, view):
+        return view.rowcol(view.size())[0] + 1
+
+    def cursor(self, view):
+        """
+        Returns (change count, line, text of the line) of a single empty selection, or None
+        """
+        sel = view.sel()
+        if len(sel) != 1 or not sel[0].empty():
+            return None
+        return view.change_count(), view.rowcol(sel[0].b)[0] + 1, view.substr(view.line(sel[0].b))
+
+    def remember(self, view, state):
+        state['rows'] = self.count_rows(view)
+        state['change_count'] = view.change_count()
+        state['cursor'] = self.cursor(view)
+
+    def reset(self, view):
+        with self.lock:
+            state = self.views.setdefault(view.id(), {'epoch': 0})
+            state['epoch'] += 1
+            state['applied'] = view.change_count()
+            state['dirty'] = set()
+            state['repaint'] = False
+        self.remember(view, state)
+
+    def forget(self, view):
+        with self.lock:
+            self.views.pop(view.id(), None)
+
+    def on_selection_modified(self, view):
+        state = self.views.get(view.id())
+        # selection of an edit can be reported before the edit itself, it mustn't replace the cursor before the edit
+        if state and state['change_count'] == view.change_count():
+            state['cursor'] = self.cursor(view)
+
+    def guess_edit(self, view, state):
+        """
+        Returns (first line, number of replaced lines, number of new lines) or None
+        """
+        before = state['cursor']
+        after = self.cursor(view)
+        if not before or not after or before[0] != state['change_count']:
+            return None
+        old_row, old_text = before[1:]
+        row, text = after[1:]
+        delta = self.count_rows(view) - state['rows']
+        if delta == 0:
+            if row != old_row or text == old_text:
+                # the cursor line didn't change, so the edit was somewhere else
+                return None
+            return row, 1, 1
+        if delta > 0:
+            # text was typed or pasted and the cursor is at its end
+            if row != old_row + delta or text == old_text:
+                # the cursor line was moved down by lines added somewhere above it (e.g. an import),
+                # or it can't be told from a new line
+                return None
+            if view.substr(view.line(view.text_point(old_row - 1, 0))) == old_text:
+                # line breaks were added at the end of the line, the line itself didn't change
+                return old_row + 1, 0, delta
+            return old_row, 1, delta + 1
+        # lines were joined into the cursor line
+        if row not in (old_row, old_row + delta):
+            return None
+        return row, 1 - delta, 1
+
+    def on_modified(self, view):
+        if not view.file_name():
+            return
+        state = self.views.get(view.id())
+        if not state:
+            return
+        edit = self.guess_edit(view, state)
+        self.remember(view, state)
+        # unfinished paint of the previous diff would add marks to the lines they had before the edit
+        painting = region_painter.cancel(view)
+
+        if not view.is_dirty():
+            # changes were undone or the file was reloaded, so the regular diff is up to date
+            self.discard(view, state)
+            hl_scheduler.schedule(view)
+            return
+        # running diff doesn't know about this edit
+        hl_scheduler.invalidate(view)
+
+        if diff_store.get(view) is None:
+            return
+        if not edit:
+            self.fallback(view, state)
+            return
+        with self.lock:
+            if painting:
+                state['dirty'].update(self.kinds)
+            epoch = state['epoch']
+        run_async = sublime.set_timeout_async if IS_ST3 else sublime.set_timeout
+        run_async(functools.partial(self.apply, view, epoch, edit, view.change_count()), 0)
+
+    def discard(self, view, state, epoch=None):
+        """
+        Drops the parsed diff and queued edits of the view, returns False if the view was diffed since `epoch`
+        """
+        with self.lock:
+            if epoch is not None and state['epoch'] != epoch:
+                return False
+            state['epoch'] += 1
+            diff_store.forget(view)
+        return True
+
+    def fallback(self, view, state, epoch=None):
+        # parsed diff no longer matches the buffer
+        if self.discard(view, state, epoch):
+            perf_stats.count('incremental_fallbacks')
+            hl_scheduler.schedule(view, get_settings().get('live_highlight_delay', 500), live=True)
+
+    def apply(self, view, epoch, edit, change_count):
+        """
+        Runs in the background, updates the parsed diff and finds marks that have to be repainted
+        """
+        state = self.views.get(view.id())
+        diff_parser = diff_store.get(view)
+        if not state or state['epoch'] != epoch or diff_parser is None:
+            return
+        first, old_count, new_count = edit
+        with perf_stats.span('incremental'):
+            # published parser can be in use on the main thread, so the edit is applied to a copy
+            diff_parser = diff_parser.copy()
+            old_ranges = diff_parser.get_line_ranges_to_hl()
+            applied = diff_parser.apply_edit(first, old_count, new_count)
+            ranges = applied and diff_parser.get_line_ranges_to_hl()
+        if not applied:
+            self.fallback(view, state, epoch)
+            return
+
+        edited = (first, first + old_count - 1)
+        with self.lock:
+            if state['epoch'] != epoch:
+                return
+            diff_store.set(view, diff_parser)
+            state['applied'] = change_count
+            for hl_key, old_lines, lines in zip(self.kinds, old_ranges, ranges):
+                if self.shift(old_lines, edited, new_count - old_count) != lines:
+                    state['dirty'].add(hl_key)
+            if viewport_highlighter.has(view):
+                state['dirty'].update(self.kinds)
+            repaint = bool(state['dirty']) and not state['repaint']
+            if repaint:
+                state['repaint'] = True
+        perf_stats.count('incremental_edits')
+        if repaint:
+            sublime.set_timeout(functools.partial(self.repaint, view, epoch), 0)
+
+    @staticmethod
+    def shift(lines, edited, delta):
+        """
+        Returns line ranges moved the way Sublime Text moves regions, or None if a range contains the edit
+        """
+        shifted = []
+        for first, last in lines:
+            if first > edited[1]:
+                shifted.append((first + delta, last + delta))
+            elif last < edited[0]:
+                shifted.append((first, last))
+            else:
+                # range contains the edit, it has to be repainted
+                return None
+        return shifted
+
+    def repaint(self, view, epoch):
+        with self.lock:
+            state = self.views.get(view.id())
+            if not state or state['epoch'] != epoch:
+                return
+            state['repaint'] = False
+            if state['applied'] != view.change_count():
+                # edits that aren't applied yet schedule the repaint again
+                return
+            dirty, state['dirty'] = state['dirty'], set()
+            diff_parser = diff_store.get(view)
+
+        settings = get_settings()
+        ranges = diff_parser.get_line_ranges_to_hl()
+        with perf_stats.span('main_thread'):
+            if viewport_highlighter.has(view):
+                viewport_highlighter.set(view, ranges, settings)
+                return
+            for hl_key, lines in zip(self.kinds, ranges):
+                if hl_key in dirty:
+                    hl_lines(view, lines, hl_key, settings)
+
+
+edit_tracker = EditTracker()
+
+
+class BatchHighlighter(object):
+    """
+    Highlights many views with one diff command per repository
+    (e.g. `git diff -- file1 file2 ...`) instead of a command per view
+    """
+
+    supported_vcs = ('git', 'hg', 'svn')
+    # keep command lines well below OS limits
+    max_command_length = 8000
+
+    def refresh(self, views):
+        groups = OrderedDict()
+        for view in views:
+            file_name = view.file_name()
+            if not file_name or not os.path.exists(file_name):
+                continue
+            vcs = get_vcs(os.path.dirname(file_name))
+            if not vcs:
+                continue
+            command = HlChangesCommand(view).get_diff_command(vcs)
+            # entry is shared with hl_changes of the view, so the key is built from the view's own command
+            cache_key = command and diff_cache_key(file_name, vcs, command)
+            path = os.path.relpath(os.path.realpath(file_name), os.path.realpath(vcs['root'])).replace(os.sep, '/')
+            if (vcs['name'] not in self.supported_vcs or view.is_dirty() or not command or
+                    command[-1] != os.path.basename(file_name) or re.search(r'[\x00-\x1f"\\]', path)):
+                # the diff command can't be shared, so highlight the view on its own
+                hl_scheduler.schedule(view)
+                continue
+            command = command[:-1]
+            if vcs['name'] == 'git':
+                # file names are taken from "+++ b/<path>" lines, so make sure prefixes are the default ones
+                # and non-ASCII names aren't quoted
+                command = command[:1] + ['-c', 'core.quotePath=false'] + command[1:2] + \
+                    ['--src-prefix=a/', '--dst-prefix=b/'] + command[2:]
+            group = groups.setdefault((vcs['name'], vcs['root']), {'vcs': vcs, 'command': command, 'views': []})
+            group['views'].append((path, view, hl_scheduler.begin(view), cache_key))
+
+        for group in groups.values():
+            batch = []
+            length = 0
+            for item in group['views']:
+                if batch and length + len(item[0]) > self.max_command_length:
+                    self.run(group['vcs'], group['command'], batch)
+                    batch = []
+                    length = 0
+                batch.append(item)
+                length += len(item[0]) + 1
+            if batch:
+                self.run(group['vcs'], group['command'], batch)
+
+    def run(self, vcs, command, items):
+        command = command + [path for path, view, generation, cache_key in items]
+        log('run command:', ' '.join(command))
+        thread = CommandThread(command, functools.partial(self.done, items), working_dir=vcs['root'],
+                               console_encoding=get_settings().get('console_encoding'),
+                               line_consumer=MultiFileDiffParser(vcs['name']), process=self.prepare,
+                               env=READ_ONLY_ENV.get(vcs['name']),
+                               max_output=HlChangesCommand(items[0][1]).max_diff_output())
+        command_pool.submit_command(thread, CommandPool.PRIORITY_BACKGROUND, repo=vcs['root'])
+
+    def prepare(self, result):
+        """
+        Runs in a worker thread, classifies changes of every file
+        """
+        for diff_parser in result.parsers.values():
+            diff_parser.get_line_ranges_to_hl()
+        return result
+
+    def done(self, items, result):
+        error = result.get_error()
+        if error:
+            log('batch diff failed:', error)
+        if result.aborted or error:
+            # files missing from incomplete output aren't necessarily clean, so they are diffed one by one
+            for path, view, generation, cache_key in items:
+                if hl_scheduler.done(view, generation):
+                    hl_scheduler.schedule(view, 0)
+            return
+        paths = set(item[0] for item in items)
+        # files that aren't in the output have no changes, if every file in the output was recognized
+        complete = not result.unmatched and all(path in paths for path in result.parsers)
+        for path, view, generation, cache_key in items:
+            diff_parser = result.parsers.get(path)
+            if diff_parser is None and not complete:
+                if hl_scheduler.done(view, generation):
+                    hl_scheduler.schedule(view, 0)
+                continue
+            diff_parser = diff_parser or DiffParser('')
+            if cache_key:
+                diff_cache.set(cache_key, diff_parser)
+            if hl_scheduler.done(view, generation):
+                with perf_stats.span('main_thread'):
+                    HlChangesCommand(view).highlight(diff_parser)
+
+
+batch_highlighter = BatchHighlighter()
+
+
+class HlChangesAllCommand(sublime_plugin.WindowCommand):
+    """
+    Re-highlights all open views, e.g. after switching branches
+    """
+
+    def run(self):
+        batch_highlighter.refresh([view for window in sublime.windows() for view in window.views()])
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding to Linux inotify
+    """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+    IN_ISDIR = 0x40000000
+
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # writing to the pipe wakes up a blocked read()
+        self.wake_fds = os.pipe()
+
+    def add_watch(self, path):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MOVED_FROM | self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        return wd if wd >= 0 else None
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        Returns list of (watch descriptor, event mask, file name) tuples
+        """
+        ready = select.select([self.fd, self.wake_fds[0]], [], [], timeout)[0]
+        if self.wake_fds[0] in ready:
+            os.read(self.wake_fds[0], 512)
+        if self.fd not in ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.event_header.size <= len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def wake(self):
+        os.write(self.wake_fds[1], b'\0')
+
+    def close(self):
+        os.close(self.fd)
+        for fd in self.wake_fds:
+            os.close(fd)
+
+
+def get_repo_watch_targets(vcs):
+    """
+    Returns list of (directory, file names) to watch for changes of repository state.
+    None instead of file names means any file in the directory and its subdirectories.
+    """
+    root = vcs['root']
+    if vcs['name'] == 'git':
+        git_dir = get_git_dir(root)
+        common_dir = _read_file(os.path.join(git_dir, 'commondir'))
+        common_dir = os.path.normpath(os.path.join(git_dir, common_dir.decode('utf-8'))) if common_dir else git_dir
+        # reflog of HEAD is appended to by commits, checkouts and resets, whatever the branch is called
+        return [(git_dir, ('HEAD', 'index')),
+                (os.path.join(git_dir, 'logs'), ('HEAD',)),
+                (common_dir, ('packed-refs',)),
+                (os.path.join(common_dir, 'refs', 'heads'), None)]
+    if vcs['name'] == 'hg':
+        return [(os.path.join(root, '.hg'), ('dirstate', 'bookmarks', 'branch'))]
+    if vcs['name'] == 'svn':
+        return [(os.path.join(root, '.svn'), ('wc.db', 'entries'))]
+    if vcs['name'] == 'bzr':
+        return [(os.path.join(root, '.bzr', 'checkout'), ('dirstate',))]
+    return []
+
+
+def _walk_dirs(directory):
+    return [path for path, dirs, files in os.walk(directory)]
+
+
+class RepoWatcher(object):
+    """
+    Watches repositories of open files for changes made outside of the editor
+    (commit, checkout, stash, ...) and re-highlights open files of the changed repository.
+
+    Uses inotify on Linux and polls the state files every `watch_repositories_interval` seconds elsewhere.
+    Events are debounced by `watch_repositories_delay` ms.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.repos = {}
+        # watch descriptor -> (root, file names, directory)
+        self.watches = {}
+        self.inotify = None
+        self.thread = None
+        self.stopped = None
+
+    def watch(self, vcs):
+        root = vcs['root']
+        with self.lock:
+            if root in self.repos:
+                return
+            targets = [t for t in get_repo_watch_targets(vcs) if os.path.isdir(t[0])]
+            self.repos[root] = {'vcs': dict(vcs), 'targets': targets, 'stamps': self._stamps(targets),
+                                'state': get_repo_state(vcs), 'generation': 0, 'wds': []}
+            if self.thread is None:
+                self._start()
+            for directory, names in targets:
+                self._add_watches(root, directory, names)
+        log('watching repository', root)
+
+    def _add_watches(self, root, directory, names):
+        """
+        Called with the lock held
+        """
+        if not self.inotify:
+            return
+        # branches with slashes in their names (feature/x) are files in subdirectories
+        for path in ([directory] if names is not None else _walk_dirs(directory)):
+            wd = self.inotify.add_watch(path)
+            if wd is not None:
+                self.watches[wd] = (root, names, path)
+                self.repos[root]['wds'].append(wd)
+
+    def unwatch(self, root):
+        with self.lock:
+            repo = self.repos.pop(root, None)
+            if repo and self.inotify:
+                for wd in repo['wds']:
+                    self.watches.pop(wd, None)
+                    self.inotify.rm_watch(wd)
+
+    def unwatch_unused(self):
+        """
+        Stops watching repositories that have no open files
+        """
+        used = set()
+        for window in sublime.windows():
+            for view in window.views():
+                vcs = view.file_name() and get_vcs(os.path.dirname(view.file_name()))
+                if vcs:
+                    used.add(vcs['root'])
+        for root in list(self.repos):
+            if root not in used:
+                self.unwatch(root)
+
+    @staticmethod
+    def _stamps(targets):
+        stamps = []
+        for directory, names in targets:
+            if names is None:
+                # a file created or renamed in a directory changes its mtime
+                stamps.extend(_stat(path) for path in _walk_dirs(directory))
+            else:
+                stamps.extend(_stat(os.path.join(directory, name)) for name in names)
+        return stamps
+
+    def _start(self):
+        """
+        Called with the lock held
+        """
+        self.stopped = threading.Event()
+        self.inotify = None
+        if sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                log('inotify is not available:', e)
+        # the thread gets its own inotify and stop event, so a restarted watcher doesn't share them
+        self.thread = threading.Thread(target=self._run, args=(self.inotify, self.stopped), name='Modific watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, inotify, stopped):
+        while not stopped.is_set():
+            if inotify:
+                for wd, mask, name in inotify.read(1):
+                    with self.lock:
+                        root, names, directory = self.watches.get(wd, (None, None, None))
+                        if root and names is None and mask & Inotify.IN_ISDIR \
+                                and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and not stopped.is_set():
+                            self._add_watches(root, os.path.join(directory, name), None)
+                    if root and not name.endswith('.lock') and (names is None or name in names):
+                        self._changed(root)
+            else:
+                stopped.wait(get_settings().get('watch_repositories_interval', 2))
+                with self.lock:
+                    repos = list(self.repos.items())
+                for root, repo in repos:
+                    stamps = self._stamps(repo['targets'])
+                    if stamps != repo['stamps']:
+                        repo['stamps'] = stamps
+                        self._changed(root)
+
+    def _changed(self, root):
+        with self.lock:
+            repo = self.repos.get(root)
+            if not repo:
+                return
+            repo['generation'] += 1
+            generation = repo['generation']
+        delay = get_settings().get('watch_repositories_delay', 500)
+        sublime.set_timeout(functools.partial(self._fire, root, generation), delay)
+
+    def _fire(self, root, generation):
+        repo = self.repos.get(root)
+        if not repo or repo['generation'] != generation:
+            return
+        state = get_repo_state(repo['vcs'])
+        if state == repo['state']:
+            # e.g. index was rewritten without changes
+            return
+        repo['state'] = state
+        views = []
+        for window in sublime.windows():
+            for view in window.views():
+                vcs = view.file_name() and get_vcs(os.path.dirname(view.file_name()))
+                if vcs and vcs['root'] == root:
+                    views.append(view)
+        log('repository changed:', root, '- refreshing', len(views), 'views')
+        batch_highlighter.refresh(views)
+
+    def shutdown(self):
+        with self.lock:
+            thread, inotify, stopped = self.thread, self.inotify, self.stopped
+            self.thread = self.inotify = self.stopped = None
+            self.repos.clear()
+            self.watches.clear()
+        if thread is None:
+            return
+        stopped.set()
+        if inotify:
+            inotify.wake()
+        thread.join(5)
+        if thread.is_alive():
+            # closed descriptor could be reused while the thread still reads from it
+            log('repository watcher thread did not stop')
+        elif inotify:
+            # watches are removed along with the descriptor
+            inotify.close()
+
+
+repo_watcher = RepoWatcher()
+
+
+class WarmUp(object):
+    """
+    Prepares VCS state of open files in the background when the plugin is loaded or a project is opened,
+    so tabs restored from a session don't pay for root discovery and a cold diff one at a time.
+
+    Roots are discovered for visible views first, then for other views and window folders.
+    Visible views are highlighted as soon as their roots are known, and a `git status` snapshot
+    is taken of every git repository found, so other tabs are highlighted from it when they are activated.
+    Warm-up jobs have the lowest priority and at most `warm_up_concurrency` of them take workers at once,
+    so they don't delay diffs of the view the user is looking at.
+    """
+
+    # a task that didn't report back within this time (in seconds), e.g. because its job was dropped,
+    # no longer holds its slot
+    task_timeout = 120
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # functions that are called with a callback to run when they are finished
+        self.tasks = deque()
+        self.running = 0
+
+    def start(self, windows=None):
+        if not get_settings().get('warm_up', True):
+            return
+        visible = []
+        others = []
+        folders = []
+        for window in (sublime.windows() if windows is None else windows):
+            shown = [window.active_view_in_group(group) for group in range(window.num_groups())]
+            shown_ids = set(view.id() for view in shown if view)
+            for view in window.views():
+                if view.file_name() and not view.is_loading():
+                    (visible if view.id() in shown_ids else others).append(view)
+            folders.extend(window.folders())
+        if visible or others or folders:
+            log('warm up:', len(visible), 'visible views,', len(others), 'other views,', len(folders), 'folders')
+            self.add(functools.partial(self.submit, functools.partial(self.discover, visible, others, folders)))
+
+    def add(self, task):
+        with self.lock:
+            self.tasks.append(task)
+        self.next()
+
+    def next(self):
+        limit = max(1, int(get_settings().get('warm_up_concurrency', 1)))
+        while True:
+            with self.lock:
+                if self.running >= limit or not self.tasks:
+                    return
+                self.running += 1
+                task = self.tasks.popleft()
+            done = self.slot()
+            try:
+                task(done)
+            except Exception:
+                done()
+                raise
+
+    def slot(self):
+        """
+        Returns a callback that frees the slot of a running task,
+        it is called by the task when it is finished, or after `task_timeout` if the task is lost
+        """
+        released = []
+
+        def done(*args):
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                self.running -= 1
+            timer.cancel()
+            self.next()
+
+        timer = threading.Timer(self.task_timeout, done)
+        timer.daemon = True
+        timer.start()
+        return done
+
+    def submit(self, job, done):
+        def run():
+            try:
+                job()
+            finally:
+                done()
+        command_pool.submit(run, CommandPool.PRIORITY_WARM_UP)
+
+    def discover(self, visible, others, folders):
+        """
+        Runs in a worker thread
+        """
+        settings = get_settings()
+        started = time.time()
+        roots = OrderedDict()
+        visible_ids = set(view.id() for view in visible)
+        directories = [(view, os.path.dirname(view.file_name())) for view in visible + others]
+        for view, directory in directories + [(None, folder) for folder in folders]:
+            vcs = get_vcs(directory)
+            if not vcs:
+                continue
+            if vcs['root'] not in roots:
+                roots[vcs['root']] = vcs
+                if view is not None and settings.get('watch_repositories', False):
+                    repo_watcher.watch(vcs)
+            if view is not None and view.id() in visible_ids:
+                main_thread(self.highlight, view)
+        perf_stats.add('warm_up', time.time() - started)
+
+        for vcs in roots.values():
+            if vcs['name'] == 'git' and settings.get('git_status_cache', True) and not git_status_cache.get(vcs):
+                self.add(functools.partial(self.prefetch_status, vcs))
+
+    def prefetch_status(self, vcs, done):
+        git_status_cache.refresh(vcs, done, CommandPool.PRIORITY_WARM_UP)
+
+    def highlight(self, view):
+        if view.is_valid() and diff_store.get(view) is None and not hl_scheduler.has(view):
+            # view hasn't been highlighted since the plugin was loaded
+            hl_scheduler.schedule(view, 0)
+
+    def stop(self):
+        with self.lock:
+            self.tasks.clear()
+
+
+warm_up = WarmUp()
+
+
 class HlChangesBackground(sublime_plugin.EventListener):
     def on_load(self, view):
         if not IS_ST3:
-            view.run_command('hl_changes')
+            hl_scheduler.schedule(view)
+
+    def watch_repository(self, view):
+        if get_settings().get('watch_repositories', False) and view.file_name():
+            vcs = get_vcs(os.path.dirname(view.file_name()))
+            if vcs:
+                repo_watcher.watch(vcs)
 
     def on_load_async(self, view):
-        view.run_command('hl_changes')
+        hl_scheduler.schedule(view)
+        self.watch_repository(view)
 
     def on_activated(self, view):
+        viewport_highlighter.resume(view)
         if not IS_ST3:
-            view.run_command('hl_changes')
+            hl_scheduler.schedule(view)
 
     def on_activated_async(self, view):
-        view.run_command('hl_changes')
+        command_pool.prioritize(view.id(), CommandPool.PRIORITY_ACTIVE)
+        hl_scheduler.schedule(view)
+        self.watch_repository(view)
 
     def on_post_save(self, view):
         if not IS_ST3:
-            view.run_command('hl_changes')
+            hl_scheduler.schedule(view)
 
     def on_post_save_async(self, view):
-        view.run_command('hl_changes')
+        hl_scheduler.schedule(view)
+        vcs = view.file_name() and get_vcs(os.path.dirname(view.file_name()))
+        if vcs and vcs['name'] == 'git' and get_settings().get('git_status_cache', True):
+            git_status_cache.touch(vcs)
+
+    def on_modified(self, view):
+        if get_settings().get('incremental_highlight', True):
+            edit_tracker.on_modified(view)
+
+    def on_selection_modified(self, view):
+        if get_settings().get('incremental_highlight', True):
+            edit_tracker.on_selection_modified(view)
+
+    def on_modified_async(self, view):
+        settings = get_settings()
+        if settings.get('live_highlight', False) and view.file_name():
+            hl_scheduler.schedule(view, settings.get('live_highlight_delay', 500))
+
+    def on_load_project_async(self, window):
+        # Sublime Text 4 only, on older versions warm-up runs when the plugin is loaded
+        warm_up.start([window])
+
+    def on_close(self, view):
+        command_pool.discard_view(view.id())
+        hl_scheduler.forget(view)
+        diff_store.forget(view)
+        edit_tracker.forget(view)
+        region_painter.cancel(view)
+        viewport_highlighter.forget(view)
+        if repo_watcher.repos:
+            sublime.set_timeout(repo_watcher.unwatch_unused, 0)
 
 
 class JumpBetweenChangesCommand(DiffCommand, sublime_plugin.TextCommand):
     def run(self, edit, direction='next'):
-        lines = self._get_lines()
-        if not lines:
+        diff_parser = diff_store.get(self.view)
+        if not diff_parser or not diff_parser.get_change_starts():
             return
 
-        if direction == 'prev':
-            lines.reverse()
-
         (current_line, col) = self.view.rowcol(self.view.sel()[0].begin())
         current_line += 1
-        jump_to = None
-        for line in lines:
-            if direction == 'next' and current_line < line:
-                jump_to = line
-                break
-            if direction == 'prev' and current_line > line:
-                jump_to = line
-                break
+        if direction == 'prev':
+            jump_to = diff_parser.get_prev_change(current_line)
+        else:
+            jump_to = diff_parser.get_next_change(current_line)
 
         if not jump_to and self.settings.get('jump_between_changes_wraps_around', True):
-            jump_to = lines[0]
+            lines = diff_parser.get_change_starts()
+            jump_to = lines[-1] if direction == 'prev' else lines[0]
 
         if jump_to is not None:
             self.goto_line(edit, jump_to)
@@ -652,24 +3930,6 @@ class JumpBetweenChangesCommand(DiffCommand, sublime_plugin.TextCommand):
 
         self.view.show(pt)
 
-    def _get_lines(self):
-        diff_parser = DiffParser.instance
-        if not diff_parser:
-            return
-
-        (inserted, changed, deleted) = diff_parser.get_lines_to_hl()
-        lines = list(set(inserted + changed + deleted))
-        lines.sort()
-
-        prev = None
-        ret_lines = []
-        for line in lines:
-            if prev != line - 1:
-                ret_lines.append(line)
-            prev = line
-
-        return ret_lines
-
 
 class UncommittedFilesCommand(VcsCommand, sublime_plugin.WindowCommand):
     def active_view(self):
@@ -692,10 +3952,35 @@ class UncommittedFilesCommand(VcsCommand, sublime_plugin.WindowCommand):
 
     def run(self):
         self.vcs = get_vcs(self.get_working_dir())
+        if self.vcs['name'] == 'git' and self.settings.get('git_status_cache', True):
+            return self.git_status_from_cache()
         status_command = getattr(self, '{0}_status_command'.format(self.vcs['name']), None)
         if status_command:
             self.run_command(status_command(), self.status_done, working_dir=self.vcs['root'])
 
+    def git_status_from_cache(self):
+        snapshot = git_status_cache.get(self.vcs)
+        if snapshot and not snapshot['dirty']:
+            self.git_snapshot_done(snapshot)
+            # files changed outside of the editor (checkout, build, ...) don't change the repository state,
+            # so the snapshot is refreshed for the next time
+            git_status_cache.refresh(self.vcs)
+            return
+
+        if self.active_view() and self.active_view().is_dirty() and self.settings.get('autosave', True):
+            self.active_view().run_command('save')
+        git_status_cache.refresh(self.vcs, self.git_snapshot_done, CommandPool.PRIORITY_USER)
+
+    def git_snapshot_done(self, snapshot):
+        if snapshot is None:
+            sublime.status_message("git status failed")
+            return
+        self.results = ['{0} {1}'.format(code.replace('.', ' '), path) for path, code in snapshot['files'].items()]
+        if self.results:
+            self.show_status_list()
+        else:
+            sublime.status_message("Nothing to show")
+
     def git_status_command(self):
         return [get_user_command('git') or 'git', 'status', '--porcelain']
 
@@ -800,6 +4085,63 @@ class UncommittedFilesCommand(VcsCommand, sublime_plugin.WindowCommand):
                     sublime.status_message("File '{0}' doesn't exist".format(fname))
 
 
+class ModificPerformanceReportCommand(VcsCommand, sublime_plugin.WindowCommand):
+    """
+    Shows timings of every stage per VCS (p50, p95 and max in ms), counters and cache stats
+    in a scratch view, or all of it as JSON if `export` is true
+    """
+
+    def active_view(self):
+        return self.window.active_view()
+
+    def is_enabled(self, **kwargs):
+        return True
+
+    def run(self, export=False, reset=False):
+        if reset:
+            perf_stats.reset()
+            sublime.status_message('Modific: performance data has been reset')
+            return
+
+        report = perf_stats.report()
+        report['pool'] = command_pool.stats()
+        report['caches'] = {
+            'vcs_root': vcs_root_cache.stats(),
+            'diff': diff_cache.stats(),
+            'base': base_cache.stats(),
+            'memory': cache_budget.stats()
+        }
+        if export:
+            output = json.dumps(report, indent=2, sort_keys=True)
+        else:
+            output = self.format_report(report)
+        self.scratch(output, title='Modific: Performance Report', syntax='Packages/Text/Plain text.tmLanguage')
+
+    def format_report(self, report):
+        lines = ['Modific performance report since {0}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report['since']))), '']
+        if not settings_snapshot.get().perf_stats:
+            lines += ['Collection is turned off, set "perf_stats": true to turn it on.', '']
+
+        row = '{0:<20} {1:<6} {2:>8} {3:>10} {4:>10} {5:>10}'
+        lines.append(row.format('Stage', 'VCS', 'Count', 'p50 ms', 'p95 ms', 'max ms'))
+        for stage in report['stages']:
+            lines.append(row.format(stage['stage'], stage['vcs'] or '-', stage['count'],
+                                    stage['p50'], stage['p95'], stage['max']))
+
+        lines += ['', '{0:<20} {1:<6} {2:>8}'.format('Counter', 'VCS', 'Count')]
+        for counter in report['counters']:
+            lines.append('{0:<20} {1:<6} {2:>8}'.format(counter['name'], counter['vcs'] or '-', counter['count']))
+
+        def format_stats(stats):
+            return ', '.join('{0}={1}'.format(k, round(v, 4) if isinstance(v, float) else v)
+                             for k, v in sorted(stats.items()))
+        lines += ['', 'Command pool: ' + format_stats(report['pool'])]
+        for name, stats in sorted(report['caches'].items()):
+            lines.append('{0} cache: {1}'.format(name, format_stats(stats)))
+        return '\n'.join(lines) + '\n'
+
+
 class ToggleHighlightChangesCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         setting_name = "highlight_changes"
@@ -814,3 +4156,17 @@ class ToggleHighlightChangesCommand(sublime_plugin.TextCommand):
 
         settings.set(setting_name, not is_on)
         sublime.save_settings("Modific.sublime-settings")
+
+
+def plugin_loaded():
+    # views restored from the session don't get on_load, so prepare them once the editor is ready
+    sublime.set_timeout(warm_up.start, 0)
+
+
+def plugin_unloaded():
+    warm_up.stop()
+    command_pool.shutdown()
+    git_cat_file.shutdown()
+    hg_servers.shutdown()
+    repo_watcher.shutdown()
+    settings_snapshot.clear()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for Modific's diff parser, VCS root discovery and highlighting pipeline.
+
+Runs outside of Sublime Text with the stub modules from benchmarks/stubs
+and prints results as JSON (times are in milliseconds):
+
+    python benchmarks/run.py [--quick] [--repeat N] [--only NAME[,NAME]] [--output FILE]
+
+Round trip benchmarks create temporary git, hg and svn repositories,
+a VCS that is not installed is reported as skipped.
+"""
+
+from __future__ import print_function
+
+import argparse
+import difflib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [os.path.join(BENCHMARKS_DIR, 'stubs'), PACKAGE_DIR]
+
+import sublime  # noqa: E402
+import Modific  # noqa: E402
+
+benchmarks = []
+
+
+def benchmark(group):
+    def register(func):
+        benchmarks.append((group, func))
+        return func
+    return register
+
+
+def measure(func, repeat, setup=None, number=1):
+    """
+    Calls func `number` times per run, `repeat` runs.
+    Setup is called before every run and its result is passed to func.
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        started = time.time()
+        for _ in range(number):
+            func(arg)
+        times.append((time.time() - started) * 1000.0 / number)
+    times.sort()
+    return {
+        'runs': repeat,
+        'calls_per_run': number,
+        'min': round(times[0], 4),
+        'median': round(times[len(times) // 2], 4),
+        'mean': round(sum(times) / len(times), 4),
+        'max': round(times[-1], 4),
+    }
+
+
+def which(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def vcs_version(command):
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8', 'replace').strip().splitlines()[0]
+
+
+# ---------------------------------------------------------------------------
+# synthetic input
+
+def make_lines(count, prefix='line'):
+    return ['{0} {1}'.format(prefix, i) for i in range(1, count + 1)]
+
+
+def diff_header(name='file.txt'):
+    return ['diff --git a/{0} b/{0}'.format(name), 'index 0000000..1111111 100644',
+            '--- a/' + name, '+++ b/' + name]
+
+
+def small_edit_diff(context, size=1000):
+    """
+    A few scattered edits (change, insertion, deletion) in a mid-sized file
+    """
+    original = make_lines(size)
+    current = list(original)
+    current[size // 10] = 'changed line'
+    current.insert(size // 2, 'inserted line')
+    del current[size * 9 // 10]
+    lines = difflib.unified_diff(original, current, n=context, lineterm='')
+    return '\n'.join(diff_header() + list(lines)[2:])
+
+
+def rewrite_diff(size):
+    """
+    Every line of the file is replaced
+    """
+    lines = diff_header() + ['@@ -1,{0} +1,{0} @@'.format(size)]
+    lines.extend('-' + line for line in make_lines(size, 'old'))
+    lines.extend('+' + line for line in make_lines(size, 'new'))
+    return '\n'.join(lines)
+
+
+def many_hunks_diff(hunks, gap=10):
+    """
+    Zero-context diff with `hunks` hunks of 2 lines, cycling between insertion, change and deletion
+    """
+    lines = diff_header()
+    offset = 0
+    for i in range(hunks):
+        old = i * gap + 1
+        kind = i % 3
+        if kind == 0:
+            lines.append('@@ -{0},0 +{1},2 @@'.format(old, old + offset + 1))
+            lines.extend(['+inserted', '+inserted'])
+            offset += 2
+        elif kind == 1:
+            lines.append('@@ -{0},2 +{1},2 @@'.format(old, old + offset))
+            lines.extend(['-old', '-old', '+new', '+new'])
+        else:
+            lines.append('@@ -{0},2 +{1},0 @@'.format(old, old + offset - 1))
+            lines.extend(['-deleted', '-deleted'])
+            offset -= 2
+    return '\n'.join(lines)
+
+
+def make_diffs(quick):
+    return {
+        'small_edit_u0': small_edit_diff(0),
+        'small_edit_u3': small_edit_diff(3),
+        'rewrite': rewrite_diff(1000 if quick else 10000),
+        'many_hunks': many_hunks_diff(500 if quick else 5000),
+    }
+
+
+def parsed(diff):
+    diff_parser = Modific.DiffParser(diff)
+    diff_parser.get_chunks()
+    return diff_parser
+
+
+def dict_layout(diff):
+    """
+    Builds what a parsed diff took before hunks were packed into arrays:
+    a dict with a list of its lines per hunk, and lists of inserted, changed and deleted line numbers
+    """
+    chunks = []
+    for line in diff.splitlines():
+        if line.startswith('@@'):
+            old, new = [part[1:].split(',') for part in line.split(' ')[1:3]]
+            old_count, new_count = int(old[1]) if len(old) > 1 else 1, int(new[1]) if len(new) > 1 else 1
+            chunks.append({'start': int(new[0]), 'end': int(new[0]) + new_count, 'lines': [],
+                           'old_start': int(old[0]), 'old_count': old_count, 'new_count': new_count})
+        elif chunks and line[:1] in ('+', '-', ' '):
+            chunks[-1]['lines'].append(line)
+    for chunk in chunks:
+        chunk['context'] = len(chunk['lines']) != chunk['old_count'] + chunk['new_count']
+    return chunks, parsed(diff).get_lines_to_hl()
+
+
+def deep_size(obj, seen=None):
+    """
+    Returns bytes taken by the object and everything it references (containers and strings)
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def make_tree(base, depth, width, marker=None):
+    """
+    Creates `depth` levels of nested directories with `width` siblings on each level,
+    returns the deepest directory
+    """
+    if marker:
+        os.makedirs(os.path.join(base, marker))
+    directory = base
+    for level in range(depth):
+        for sibling in range(1, width):
+            os.makedirs(os.path.join(directory, 'sibling{0}'.format(sibling)))
+        directory = os.path.join(directory, 'level{0}'.format(level))
+        os.makedirs(directory)
+    return directory
+
+
+# ---------------------------------------------------------------------------
+# benchmarks
+
+@benchmark('parser')
+def bench_parser(ctx):
+    results = {}
+    for name, diff in sorted(ctx['diffs'].items()):
+        results['get_chunks.' + name] = measure(
+            lambda diff_parser: diff_parser.get_chunks(), ctx['repeat'],
+            setup=lambda: Modific.DiffParser(diff))
+
+        def stream(lines):
+            diff_parser = Modific.DiffParser()
+            for line in lines:
+                diff_parser.feed(line)
+            diff_parser.close()
+        results['feed.' + name] = measure(stream, ctx['repeat'], setup=lambda: diff.splitlines())
+
+        results['get_lines_to_hl.' + name] = measure(
+            lambda diff_parser: diff_parser.get_lines_to_hl(), ctx['repeat'], setup=lambda: parsed(diff))
+        results['get_line_ranges_to_hl.' + name] = measure(
+            lambda diff_parser: diff_parser.get_line_ranges_to_hl(), ctx['repeat'], setup=lambda: parsed(diff))
+        diff_parser = parsed(diff)
+        diff_parser.get_line_ranges_to_hl()
+        # what a cached diff takes, compared to its text and to the dict-of-lists layout it replaced
+        results['memory_size.' + name] = {'bytes': diff_parser.memory_size(), 'diff_bytes': len(diff),
+                                          'dict_layout_bytes': deep_size(dict_layout(diff))}
+    return results
+
+
+@benchmark('parser')
+def bench_original_part(ctx):
+    results = {}
+    for name, diff in sorted(ctx['diffs'].items()):
+        diff_parser = parsed(diff)
+        hunks = diff_parser.get_chunks()
+        last_line = max([hunks.end(i) for i in range(len(hunks))] or [1])
+        step = max(1, last_line // 100)
+        lines = list(range(1, last_line + 1, step))
+
+        def lookup(arg):
+            for line in lines:
+                diff_parser.get_original_part(line)
+        result = measure(lookup, ctx['repeat'])
+        result['lookups_per_run'] = len(lines)
+        results['get_original_part.' + name] = result
+    return results
+
+
+@benchmark('vcs')
+def bench_get_vcs(ctx):
+    results = {}
+    depth = 10 if ctx['quick'] else 40
+    for name, marker in (('repo', '.git'), ('no_repo', None)):
+        base = tempfile.mkdtemp(prefix='modific-bench-tree-', dir=ctx['tmp'])
+        leaf = make_tree(base, depth, 5, marker)
+
+        def cold(arg):
+            Modific.vcs_root_cache.invalidate()
+            Modific.get_vcs(leaf)
+        results['get_vcs.cold.' + name] = measure(cold, ctx['repeat'])
+        Modific.get_vcs(leaf)
+        results['get_vcs.warm.' + name] = measure(lambda arg: Modific.get_vcs(leaf), ctx['repeat'], number=100)
+    return results
+
+
+@benchmark('highlight')
+def bench_hl_lines(ctx):
+    results = {}
+    settings = Modific.get_settings()
+    for name in ('small_edit_u0', 'many_hunks', 'rewrite'):
+        ranges = parsed(ctx['diffs'][name]).get_line_ranges_to_hl()
+        last_line = max([last for kind in ranges for first, last in kind] or [1])
+        view = sublime.View()
+        view.set_text('\n'.join(make_lines(last_line + 10)))
+
+        def paint(arg):
+            for hl_key, lines in zip(('inserted', 'changed', 'deleted'), ranges):
+                Modific.hl_lines(view, lines, hl_key, settings)
+        result = measure(paint, ctx['repeat'])
+        result['regions'] = sum(len(view.get_regions(key)) for key in ('inserted', 'changed', 'deleted'))
+        results['hl_lines.' + name] = result
+    return results
+
+
+def run(command, cwd):
+    subprocess.check_call(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def create_repo(vcs_name, base, lines):
+    """
+    Creates a repository with one committed file and returns path of that file
+    """
+    work = os.path.join(base, vcs_name)
+    if vcs_name == 'svn':
+        server = os.path.join(base, 'svn-server')
+        run(['svnadmin', 'create', server], base)
+        run(['svn', 'checkout', '-q', 'file://' + server, work], base)
+    else:
+        os.makedirs(work)
+        run([vcs_name, 'init', '-q'] if vcs_name == 'git' else [vcs_name, 'init'], work)
+
+    file_name = os.path.join(work, 'file.txt')
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    if vcs_name == 'git':
+        run(['git', 'add', 'file.txt'], work)
+        run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'init'], work)
+    elif vcs_name == 'hg':
+        run(['hg', 'add', 'file.txt'], work)
+        run(['hg', 'commit', '-u', 'bench', '-m', 'init'], work)
+    else:
+        run(['svn', 'add', '-q', 'file.txt'], work)
+        run(['svn', 'commit', '-q', '-m', 'init'], work)
+    return file_name
+
+
+def highlight(view, timeout=60):
+    """
+    Runs hl_changes through the scheduler and waits until the view is repainted
+    """
+    updates = view.region_updates.get('changed', 0)
+    Modific.hl_scheduler.schedule(view, 0)
+    if not sublime.run_until(lambda: view.region_updates.get('changed', 0) > updates, timeout):
+        raise RuntimeError('hl_changes timed out for ' + view.file_name())
+
+
+@benchmark('round_trip')
+def bench_round_trip(ctx):
+    results = {}
+    size = 500 if ctx['quick'] else 2000
+    for vcs_name in ('git', 'hg', 'svn'):
+        if not which(vcs_name) or (vcs_name == 'svn' and not which('svnadmin')):
+            results['hl_changes.' + vcs_name] = {'skipped': vcs_name + ' is not installed'}
+            continue
+
+        base = tempfile.mkdtemp(prefix='modific-bench-' + vcs_name + '-', dir=ctx['tmp'])
+        lines = make_lines(size)
+        file_name = create_repo(vcs_name, base, lines)
+        for i in range(0, size, 50):
+            lines[i] = 'changed line'
+        with open(file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        window = sublime.Window([os.path.dirname(file_name)])
+        sublime._windows[:] = [window]
+        view = window.open_file(file_name)
+        highlight(view)
+        painted = len(view.get_regions('changed'))
+
+        results['hl_changes.uncached.' + vcs_name] = measure(
+            lambda arg: highlight(view), ctx['repeat'], setup=lambda: Modific.diff_cache.clear())
+        results['hl_changes.cached.' + vcs_name] = measure(lambda arg: highlight(view), ctx['repeat'])
+        results['hl_changes.uncached.' + vcs_name]['regions'] = painted
+
+        window.close(view)
+        Modific.HlChangesBackground().on_close(view)
+        sublime._windows[:] = []
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='use smaller inputs')
+    parser.add_argument('--repeat', type=int, default=None, help='number of runs of every benchmark')
+    parser.add_argument('--only', default='', help='comma separated groups: ' +
+                        ', '.join(sorted(set(group for group, func in benchmarks))))
+    parser.add_argument('--output', default=None, help='write JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    settings = Modific.get_settings()
+    settings.set('highlight_changes', True)
+
+    only = set(filter(None, args.only.split(',')))
+    tmp = tempfile.mkdtemp(prefix='modific-bench-')
+    ctx = {
+        'quick': args.quick,
+        'repeat': args.repeat or (5 if args.quick else 20),
+        'tmp': tmp,
+        'diffs': make_diffs(args.quick),
+    }
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'repeat': ctx['repeat'],
+            'unit': 'ms',
+            'vcs': dict((name, vcs_version([name, '--version'])) for name in ('git', 'hg', 'svn')),
+        },
+        'results': {},
+    }
+    try:
+        for group, func in benchmarks:
+            if only and group not in only:
+                continue
+            for name, result in sorted(func(ctx).items()):
+                report['results'][group + '.' + name] = result
+    finally:
+        Modific.plugin_unloaded()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal stand-in for the `sublime` module, enough to import and drive Modific outside of Sublime Text.
+
+Timeouts are queued and run by `run_pending()`, which plays the role of the main thread.
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+HIDDEN = 128
+DRAW_EMPTY = 1
+LITERAL = 1
+MONOSPACE_FONT = 1
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_settings = {}
+_windows = []
+_timeouts = []
+_timeouts_lock = threading.Lock()
+_counter = itertools.count()
+
+
+def version():
+    return '4126'
+
+
+def platform():
+    return 'linux'
+
+
+class Settings(object):
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def erase(self, key):
+        self.data.pop(key, None)
+
+    def has(self, key):
+        return key in self.data
+
+    def add_on_change(self, key, callback):
+        self.callbacks[key] = callback
+
+    def clear_on_change(self, key):
+        self.callbacks.pop(key, None)
+
+
+def _read_settings_file(name):
+    path = os.path.join(PACKAGE_DIR, name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        text = f.read()
+    # settings files allow comments and trailing commas
+    text = re.sub(r'^\s*//.*$', '', text, flags=re.M)
+    text = re.sub(r',(\s*[}\]])', r'\1', text)
+    return json.loads(text)
+
+
+def load_settings(name):
+    if name not in _settings:
+        _settings[name] = Settings(_read_settings_file(name))
+    return _settings[name]
+
+
+def save_settings(name):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    with _timeouts_lock:
+        heapq.heappush(_timeouts, (time.time() + delay / 1000.0, next(_counter), callback))
+
+
+set_timeout_async = set_timeout
+
+
+def run_pending():
+    """
+    Runs callbacks that are due, returns number of callbacks that ran
+    """
+    count = 0
+    while True:
+        with _timeouts_lock:
+            if not _timeouts or _timeouts[0][0] > time.time():
+                return count
+            callback = heapq.heappop(_timeouts)[2]
+        callback()
+        count += 1
+
+
+def run_until(predicate, timeout=60):
+    """
+    Runs the main loop until predicate() is true, returns False on timeout
+    """
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        if not run_pending():
+            time.sleep(0.0005)
+    return True
+
+
+def status_message(message):
+    pass
+
+
+def error_message(message):
+    pass
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _windows[0] if _windows else None
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+    def __repr__(self):
+        return 'Region(%d, %d)' % (self.a, self.b)
+
+
+class Selection(list):
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+class View(object):
+    """
+    Text buffer with the parts of the view API that Modific uses
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, file_name=None, window=None):
+        self.view_id = next(self._ids)
+        self.path = file_name
+        self.win = window
+        self.view_settings = Settings()
+        self.selection = Selection([Region(0)])
+        self.regions = {}
+        self.region_updates = {}
+        self.status = {}
+        self.dirty = False
+        self.valid = True
+        self.changes = 0
+        self.set_text('')
+        if file_name and os.path.exists(file_name):
+            with open(file_name) as f:
+                self.set_text(f.read())
+
+    def set_text(self, text):
+        self.text = text
+        self.changes += 1
+        self.line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+
+    def id(self):
+        return self.view_id
+
+    def change_count(self):
+        return self.changes
+
+    def buffer_id(self):
+        return self.view_id
+
+    def file_name(self):
+        return self.path
+
+    def window(self):
+        return self.win
+
+    def settings(self):
+        return self.view_settings
+
+    def is_valid(self):
+        return self.valid
+
+    def is_dirty(self):
+        return self.dirty
+
+    def is_loading(self):
+        return False
+
+    def set_read_only(self, value):
+        pass
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def text_point(self, row, col):
+        row = max(0, min(row, len(self.line_starts) - 1))
+        return self.line_starts[row] + col
+
+    def rowcol(self, point):
+        row = bisect.bisect_right(self.line_starts, point) - 1
+        return row, point - self.line_starts[row]
+
+    def line(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        row = self.rowcol(point)[0]
+        begin = self.line_starts[row]
+        end = self.line_starts[row + 1] - 1 if row + 1 < len(self.line_starts) else len(self.text)
+        return Region(begin, end)
+
+    def full_line(self, point):
+        line = self.line(point)
+        return Region(line.a, min(line.b + 1, len(self.text)))
+
+    def lines(self, region):
+        first = self.rowcol(region.begin())[0]
+        last = self.rowcol(region.end())[0]
+        return [self.line(self.line_starts[row]) for row in range(first, last + 1)]
+
+    def visible_region(self):
+        return Region(0, len(self.text))
+
+    def sel(self):
+        return self.selection
+
+    def show(self, *args):
+        pass
+
+    def add_regions(self, key, regions, *args):
+        self.regions[key] = list(regions)
+        self.region_updates[key] = self.region_updates.get(key, 0) + 1
+
+    def get_regions(self, key):
+        return list(self.regions.get(key, []))
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+        self.region_updates[key] = self.region_updates.get(key, 0) + 1
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def run_command(self, name, args=None):
+        import sublime_plugin
+        sublime_plugin.run_text_command(self, name, args or {})
+
+
+class Window(object):
+    def __init__(self, folders=()):
+        self.window_views = []
+        self.window_folders = list(folders)
+        self.active = None
+
+    def id(self):
+        return 1
+
+    def views(self):
+        return list(self.window_views)
+
+    def active_view(self):
+        return self.active
+
+    def num_groups(self):
+        return 1
+
+    def active_view_in_group(self, group):
+        return self.active
+
+    def folders(self):
+        return list(self.window_folders)
+
+    def open_file(self, file_name):
+        view = View(file_name, self)
+        self.window_views.append(view)
+        self.active = view
+        return view
+
+    def close(self, view):
+        view.valid = False
+        self.window_views.remove(view)
+        if self.active is view:
+            self.active = self.window_views[-1] if self.window_views else None
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal stand-in for the `sublime_plugin` module
+"""
+
+import sys
+
+# module whose commands are looked up by run_text_command()
+commands_module = None
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class EventListener(object):
+    pass
+
+
+def command_class(name):
+    module = commands_module or sys.modules.get('Modific')
+    class_name = ''.join(part.title() for part in name.split('_')) + 'Command'
+    return getattr(module, class_name, None)
+
+
+def run_text_command(view, name, args):
+    cls = command_class(name)
+    if cls is None:
+        return
+    command = cls(view)
+    if not command.is_enabled(**args):
+        return
+    command.run(None, **args)
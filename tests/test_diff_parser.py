@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that DiffParser classifies changed lines the same way as the per-line classifier
+it replaced, for diffs with context lines and zero-context (-U0) diffs.
+
+    python -m unittest discover tests
+"""
+
+import difflib
+import os
+import random
+import re
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [os.path.join(PACKAGE_DIR, 'benchmarks', 'stubs'), PACKAGE_DIR]
+
+import Modific  # noqa: E402
+
+HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+def classify_per_line(diff):
+    """
+    Original classifier: walks every line of every hunk and returns lists of line numbers
+    """
+    hunks = []
+    for line in diff.splitlines():
+        match = HEADER.match(line)
+        if match:
+            start = int(match.group(3))
+            if match.group(4) == '0':
+                # deleted lines are marked on the line after the deletion
+                start += 1
+            hunks.append((start, []))
+        elif hunks and not line.startswith('\\'):
+            hunks[-1][1].append(line)
+
+    inserted = []
+    changed = []
+    deleted = []
+    for current, lines in hunks:
+        deleted_line = None
+        for line in lines:
+            if line.startswith('-'):
+                if not deleted_line or deleted_line not in deleted:
+                    deleted.append(current)
+                deleted_line = current
+            elif line.startswith('+'):
+                if deleted_line:
+                    deleted.pop()
+                    deleted_line = None
+                    changed.append(current)
+                elif current - 1 in changed:
+                    changed.append(current)
+                else:
+                    inserted.append(current)
+                current += 1
+            else:
+                deleted_line = None
+                current += 1
+    return inserted, changed, deleted
+
+
+def make_diff(original, modified, context):
+    return '\n'.join(difflib.unified_diff(original, modified, 'a', 'b', n=context, lineterm=''))
+
+
+def expand(ranges):
+    return tuple([line for first, last in kind for line in range(first, last + 1)] for kind in ranges)
+
+
+class ClassificationTest(unittest.TestCase):
+
+    def check(self, diff):
+        expected = classify_per_line(diff)
+        diff_parser = Modific.DiffParser(diff)
+        self.assertEqual(diff_parser.get_lines_to_hl(), expected, diff)
+        self.assertEqual(expand(diff_parser.get_line_ranges_to_hl()), expected, diff)
+
+        streamed = Modific.DiffParser()
+        for line in diff.splitlines():
+            streamed.feed(line)
+        streamed.close()
+        self.assertEqual(streamed.get_lines_to_hl(), expected, diff)
+
+    def test_insertion(self):
+        self.check('@@ -3,0 +4,2 @@\n+a\n+b')
+        self.check('@@ -2,2 +2,4 @@\n l2\n+a\n+b\n l3')
+
+    def test_change(self):
+        self.check('@@ -3,2 +3,3 @@\n-x\n-y\n+a\n+b\n+c')
+        self.check('@@ -2,4 +2,4 @@\n l2\n-x\n+a\n l4\n l5')
+
+    def test_deletion(self):
+        self.check('@@ -3,2 +2,0 @@\n-x\n-y')
+        self.check('@@ -1,4 +1,2 @@\n l1\n-x\n-y\n l4')
+
+    def test_mixed_hunk(self):
+        self.check('@@ -1,6 +1,6 @@\n l1\n-x\n+a\n+b\n l3\n-y\n l5\n+c\n l6')
+
+    def test_no_newline_marker(self):
+        self.check('@@ -1,2 +1,2 @@\n l1\n-x\n\\ No newline at end of file\n+a\n\\ No newline at end of file')
+
+    def test_random_diffs(self):
+        rnd = random.Random(10)
+        for _ in range(300):
+            original = ['line {0}'.format(rnd.randint(0, 20)) for _ in range(rnd.randint(0, 40))]
+            modified = list(original)
+            for _ in range(rnd.randint(1, 6)):
+                pos = rnd.randint(0, len(modified))
+                action = rnd.random()
+                if action < 0.35:
+                    modified[pos:pos] = ['new {0}'.format(rnd.randint(0, 9))] * rnd.randint(1, 3)
+                elif action < 0.7:
+                    del modified[pos:pos + rnd.randint(1, 3)]
+                elif modified:
+                    modified[min(pos, len(modified) - 1)] = 'changed {0}'.format(rnd.randint(0, 9))
+            for context in (0, 1, 3):
+                self.check(make_diff(original, modified, context))
+
+
+if __name__ == '__main__':
+    unittest.main()